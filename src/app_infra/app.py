@@ -3,10 +3,13 @@ from fastapi import FastAPI
 from app_infra.exceptions_handler import add_exception_handlers
 from app_infra.lifespan import add_lifespan
 from app_infra.middlewares import add_middlewares
+from app_infra.serialization import UtcZResponse
 from router import add_routers
 
 
 def make_app(app: FastAPI) -> FastAPI:
+    # routes included from here on encode with orjson
+    app.router.default_response_class = UtcZResponse
     add_routers(app)
     add_middlewares(app)
     add_exception_handlers(app)
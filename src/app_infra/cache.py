@@ -1,11 +1,63 @@
+import asyncio
+import json
+
 from aredis_om import get_redis_connection, Migrator
+from redis.asyncio import Redis
 
+from app_infra.app_logger import get_logger
 from config import settings
-from model.cache import ProductCache
+from helpers.local_cache import LocalCache
+from model.cache import ProductCache, ProductIndex
+
+logger = get_logger()
+
+# cache repos publish the redis keys they change here, so every worker can drop them from its local caches
+invalidation_channel = 'fast_shop:invalidate'
+
+cache_models = [ProductCache, ProductIndex]
+
+redis_conn: Redis | None = None
+
+
+def connect_redis() -> Redis:
+    """returns the process wide redis client (and its connection pool), creating it on first use"""
+    global redis_conn
+    if redis_conn is None:
+        redis_conn = get_redis_connection(
+            url=settings.redis_url, decode_responses=True, max_connections=settings.redis_max_connections
+        )
+        for model in cache_models:
+            model.Meta.database = redis_conn
+    return redis_conn
 
 
 async def make_cache():
-    redis_conn = get_redis_connection(url=settings.redis_url, decode_responses=True)
-    ProductCache.Meta.database = redis_conn
+    connect_redis()
     await Migrator().run()
-    await redis_conn.close()
+
+
+async def listen_for_invalidations():
+    """keeps the local caches of this worker coherent; they are only enabled while we are subscribed"""
+    while True:
+        pubsub = connect_redis().pubsub(ignore_subscribe_messages=True)
+        try:
+            await pubsub.subscribe(invalidation_channel)
+            LocalCache.set_enabled_everywhere(True)
+            async for message in pubsub.listen():
+                LocalCache.evict_everywhere(json.loads(message['data']))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning('cache invalidation subscription lost', error=str(e))
+            await asyncio.sleep(1)
+        finally:
+            # we may miss invalidations until we subscribe again
+            LocalCache.set_enabled_everywhere(False)
+            await pubsub.close()
+
+
+async def clean_cache():
+    global redis_conn
+    if redis_conn is not None:
+        await redis_conn.close(close_connection_pool=True)
+        redis_conn = None
@@ -1,17 +1,13 @@
-from aredis_om import get_redis_connection
+from redis.asyncio import Redis
 
-from config import settings
-from db import async_session_maker
+from app_infra.cache import connect_redis
+from db import UnitOfWork
 
 
-async def get_db_session():
-    async with async_session_maker() as session:
-        yield session
+async def get_unit_of_work():
+    async with UnitOfWork() as uow:
+        yield uow
 
 
-async def get_redis():
-    redis_conn = get_redis_connection(url=settings.redis_url, decode_responses=True)
-    try:
-        yield redis_conn
-    finally:
-        await redis_conn.close()
+def get_redis() -> Redis:
+    return connect_redis()
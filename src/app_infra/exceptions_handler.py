@@ -23,7 +23,8 @@ def add_exception_handlers(app: FastAPI) -> None:
                 'message': exc.detail,
                 'request_id': request.state.request_id,
             },
-            status_code=exc.status_code
+            status_code=exc.status_code,
+            headers=exc.headers,
         )
         return response
 
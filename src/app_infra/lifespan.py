@@ -1,10 +1,16 @@
+import asyncio
 from contextlib import asynccontextmanager
 
 from fastapi import FastAPI
 
 from app_infra.app_logger import make_logger
-from app_infra.cache import make_cache
-from db import make_db, clean_db
+from app_infra.cache import make_cache, clean_cache, listen_for_invalidations
+from app_infra.outbox import outbox_relay
+from app_infra.revocation import revocations
+from app_infra.warmup import cache_warmer
+from config import settings
+from db import make_db, clean_db, replica_router
+from helpers.crypto import hash_pool
 
 
 @asynccontextmanager
@@ -12,7 +18,23 @@ async def lifespan(app: FastAPI):
     make_logger()
     await make_db()
     await make_cache()
+    tasks = [
+        asyncio.create_task(replica_router.run_health_checks()),
+        asyncio.create_task(listen_for_invalidations()),
+        asyncio.create_task(outbox_relay.run()),
+        asyncio.create_task(revocations.listen()),
+    ]
+    if settings.cache_warmup:
+        tasks.append(asyncio.create_task(cache_warmer.keep_warm()))
+    else:
+        cache_warmer.ready = True
     yield
+    for task in tasks:
+        task.cancel()
+    # let them unwind (close subscriptions, release locks) before their connections go away
+    await asyncio.gather(*tasks, return_exceptions=True)
+    hash_pool.shutdown()
+    await clean_cache()
     await clean_db()
 
 
@@ -0,0 +1,32 @@
+from collections import defaultdict
+
+
+class Metrics:
+    """process-local counters and timings, exposed as json on GET /metrics"""
+
+    def __init__(self):
+        self.counters: dict[str, float] = defaultdict(int)
+        self.gauges: dict[str, float] = {}
+        self.timings: dict[str, dict] = defaultdict(lambda: {'count': 0, 'total': 0.0, 'max': 0.0})
+
+    def inc(self, name: str, value: float = 1):
+        self.counters[name] += value
+
+    def set(self, name: str, value: float):
+        self.gauges[name] = value
+
+    def observe(self, name: str, seconds: float):
+        timing = self.timings[name]
+        timing['count'] += 1
+        timing['total'] += seconds
+        timing['max'] = max(timing['max'], seconds)
+
+    def ratio(self, hits: str, misses: str) -> float | None:
+        total = self.counters[hits] + self.counters[misses]
+        return self.counters[hits] / total if total else None
+
+    def snapshot(self) -> dict:
+        return {'counters': dict(self.counters), 'gauges': dict(self.gauges), 'timings': dict(self.timings)}
+
+
+metrics = Metrics()
@@ -1,16 +1,33 @@
 import uuid
 
-from fastapi import FastAPI, Request
+from fastapi import FastAPI, Request, HTTPException
 
 from app_infra.app_logger import get_logger
+from config import settings
+from db import sticky_key, sticky, replica_router
+from helpers.crypto import Crypto
 
 logger = get_logger()
 
 
+def client_key(request: Request) -> str | None:
+    """the user of the access token, or the client ip for anonymous requests"""
+    if token := request.headers.get(settings.auth_scheme.model.name):
+        try:
+            return f'user:{Crypto.verify_token(token)["sub"]}'
+        except HTTPException:
+            pass
+    return request.client and f'ip:{request.client.host}'
+
+
 def add_middlewares(app: FastAPI):
 
     @app.middleware('http')
     async def add_request_id(request: Request, call_next):
         request.state.request_id = str(uuid.uuid4())
+        if replica_router.engines and (client := client_key(request)):
+            # read-your-writes stickiness of replica reads, shared by all workers
+            sticky_key.set(client)
+            sticky.set(await replica_router.wrote_recently(client))
         response = await call_next(request)
         return response
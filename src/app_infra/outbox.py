@@ -0,0 +1,101 @@
+import asyncio
+import time
+import uuid
+from contextlib import suppress
+from datetime import datetime, UTC
+
+from app_infra.app_logger import get_logger
+from app_infra.cache import connect_redis
+from app_infra.metrics import metrics
+from config import settings
+from data._base import CacheRepo
+from data.outbox import OutboxRepo
+from data.product import ProductRepo, ProductCacheRepo
+from db import UnitOfWork
+from model.enums import CacheChange
+
+logger = get_logger()
+
+
+class OutboxRelay:
+    """
+    applies the committed CacheOutbox rows to redis in batches. the rows only name what changed, the relay writes the
+    current database state of it, so several changes of a product coalesce into one write and a late or repeated
+    relay can't put an old version in the cache. one worker of the cluster relays at a time
+    """
+
+    lock_key = 'fast_shop:outbox_lock'
+
+    def __init__(self):
+        self._wake = asyncio.Event()
+
+    async def notify(self):
+        """called after a transaction that wrote to the outbox commits"""
+        if settings.outbox_inline:
+            await self.drain()
+        else:
+            self._wake.set()
+
+    async def run(self):
+        failures = 0
+        while True:
+            self._wake.clear()
+            try:
+                relayed = await self.drain()
+                failures = 0
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # the rows stay in the outbox, retry them with a backoff
+                failures += 1
+                metrics.inc('cache_outbox.failures')
+                logger.warning('cache outbox relay failed', error=str(e), failures=failures)
+                await asyncio.sleep(min(settings.outbox_poll_seconds * 2 ** failures, 30))
+                continue
+            if relayed < settings.outbox_batch_size:
+                with suppress(TimeoutError):
+                    async with asyncio.timeout(settings.outbox_poll_seconds):
+                        await self._wake.wait()
+
+    async def drain(self) -> int:
+        """relays one batch and returns its size; 0 when the outbox is empty or another worker is relaying"""
+        redis = connect_redis()
+        token = str(uuid.uuid4())
+        if not await redis.set(self.lock_key, token, nx=True, px=int(settings.outbox_lock_lease * 1000)):
+            return 0
+        try:
+            # reads go to the primary and the batch is removed only if redis took all of it
+            async with UnitOfWork() as uow, uow.transaction():
+                outbox_repo = OutboxRepo(uow)
+                batch = await outbox_repo.next_batch(settings.outbox_batch_size)
+                if not batch:
+                    return 0
+                started = time.monotonic()
+                metrics.set('cache_outbox.lag_seconds', self._age(batch[0].created_at))
+
+                product_ids = {row.entity_id for row in batch}
+                products = await ProductRepo(uow).get_by_ids(list(product_ids))
+                cache_repo = ProductCacheRepo(redis)
+                await cache_repo.save(*products)
+                await cache_repo.delete(*(product_ids - {p.id for p in products}))
+                if any(row.change == CacheChange.product.value for row in batch):
+                    await cache_repo.bump_catalog_version()
+
+                await outbox_repo.remove([row.id for row in batch])
+            metrics.inc('cache_outbox.relayed', len(batch))
+            metrics.inc('cache_outbox.coalesced', len(batch) - len(product_ids))
+            metrics.observe('cache_outbox.batch', time.monotonic() - started)
+            return len(batch)
+        finally:
+            await redis.eval(CacheRepo.release_lock_script, 1, self.lock_key, token)
+
+    @staticmethod
+    def _age(created_at: datetime | None) -> float:
+        if created_at is None:
+            return 0
+        if created_at.tzinfo is None:  # sqlite drops the timezone, its now() is utc
+            created_at = created_at.replace(tzinfo=UTC)
+        return max((datetime.now(UTC) - created_at).total_seconds(), 0)
+
+
+outbox_relay = OutboxRelay()
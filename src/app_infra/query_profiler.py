@@ -0,0 +1,79 @@
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Callable
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+# every profile in this tuple records the queries run by the current task (LogRoute opens one per request, tests may
+# open an outer one around several requests)
+_active_profiles: ContextVar[tuple['QueryProfile', ...]] = ContextVar('active_query_profiles', default=())
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+@dataclass
+class QueryProfile:
+    count: int = 0
+    total_time: float = 0.0
+    slowest_time: float = 0.0
+    slowest_statement: str | None = None
+    statements: Counter = field(default_factory=Counter)
+
+    def record(self, statement: str, duration: float):
+        self.count += 1
+        self.total_time += duration
+        self.statements[statement] += 1
+        if duration > self.slowest_time:
+            self.slowest_time = duration
+            self.slowest_statement = statement
+
+    @property
+    def duplicates(self) -> dict[str, int]:
+        """statements run more than once, which in a single request usually means an N+1 query"""
+        return {s: n for s, n in self.statements.items() if n > 1}
+
+    def summary(self) -> dict:
+        return {
+            'query_count': self.count,
+            'db_time': self.total_time,
+            'slowest_time': self.slowest_time,
+            'slowest_statement': self.slowest_statement,
+            'duplicate_count': sum(n - 1 for n in self.duplicates.values()),
+        }
+
+
+@contextmanager
+def profile_queries():
+    profile = QueryProfile()
+    token = _active_profiles.set(_active_profiles.get() + (profile,))
+    try:
+        yield profile
+    finally:
+        _active_profiles.reset(token)
+
+
+def query_budget(max_queries: int):
+    """declares the most queries an endpoint may run, checked by LogRoute. apply it below the router decorator"""
+    def decorator(endpoint: Callable) -> Callable:
+        endpoint.query_budget = max_queries
+        return endpoint
+    return decorator
+
+
+def instrument_engine(engine: AsyncEngine):
+
+    @event.listens_for(engine.sync_engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        context.query_start_time = time.perf_counter()
+
+    @event.listens_for(engine.sync_engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        duration = time.perf_counter() - context.query_start_time
+        for profile in _active_profiles.get():
+            profile.record(statement, duration)
@@ -0,0 +1,117 @@
+import time
+import uuid
+from collections import OrderedDict
+
+from redis.asyncio import Redis
+from redis.commands.core import AsyncScript
+from redis.exceptions import RedisError
+
+from app_infra.app_logger import get_logger
+from app_infra.cache import connect_redis
+from app_infra.metrics import metrics
+from config import settings
+from helpers.exceptions import too_many_requests_exception
+
+logger = get_logger()
+
+
+class TokenBuckets:
+    """in-process token bucket per key, refilled at the rate the key is allowed cluster wide; the least recently used
+    buckets are dropped beyond max_keys"""
+
+    def __init__(self, capacity: int, per_seconds: float, max_keys: int):
+        self.capacity = capacity
+        self.rate = capacity / per_seconds
+        self.max_keys = max_keys
+        self._buckets: OrderedDict[str, tuple[float, float]] = OrderedDict()  # key -> tokens, updated at
+
+    def wait_time(self, key: str) -> float:
+        """seconds until the key has a token again, 0 when it has one now"""
+        tokens = self._tokens(key, time.monotonic())
+        return 0 if tokens >= 1 else (1 - tokens) / self.rate
+
+    def take(self, key: str):
+        now = time.monotonic()
+        self._buckets[key] = (self._tokens(key, now) - 1, now)
+        self._buckets.move_to_end(key)
+        if len(self._buckets) > self.max_keys:
+            self._buckets.popitem(last=False)
+
+    def _tokens(self, key: str, now: float) -> float:
+        tokens, updated_at = self._buckets.get(key, (self.capacity, now))
+        return min(tokens + (now - updated_at) * self.rate, self.capacity)
+
+
+class RateLimiter:
+    """
+    sliding window limit per key over the whole cluster, kept in redis as a sorted set of attempt times per key. all
+    keys of an attempt are checked and counted by one script, and a rejected attempt is not counted. token buckets in
+    the worker shed floods before they reach redis; while redis fails they are the only limit
+    """
+
+    # KEYS: the limited keys; ARGV: window (ms), attempt id, then the limit of each key. returns the ms to wait, or 0
+    # when the attempt was counted
+    hit_script = """
+        local time = redis.call('TIME')
+        local now = time[1] * 1000 + math.floor(time[2] / 1000)
+        local window = tonumber(ARGV[1])
+        local wait = 0
+        for i, key in ipairs(KEYS) do
+            redis.call('ZREMRANGEBYSCORE', key, '-inf', now - window)
+            if redis.call('ZCARD', key) >= tonumber(ARGV[i + 2]) then
+                local oldest = redis.call('ZRANGE', key, 0, 0, 'WITHSCORES')
+                wait = math.max(wait, tonumber(oldest[2]) + window - now)
+            end
+        end
+        if wait > 0 then
+            return wait
+        end
+        for _, key in ipairs(KEYS) do
+            redis.call('ZADD', key, now, ARGV[2])
+            redis.call('PEXPIRE', key, window)
+        end
+        return 0
+    """
+
+    def __init__(self, name: str, window: float, limits: dict[str, int]):
+        self.name = name
+        self.window = window
+        self.limits = limits  # kind of key (e.g. ip) -> attempts allowed in the window
+        self.buckets = {
+            kind: TokenBuckets(limit, window, settings.rate_limit_local_keys) for kind, limit in limits.items()
+        }
+        self._hit: AsyncScript | None = None
+
+    async def hit(self, **keys: str | None):
+        """counts an attempt for each given key (kind=key), or raises a 429 with Retry-After if one is over its limit"""
+        keys = {kind: key for kind, key in keys.items() if key}
+        if wait := max((self.buckets[kind].wait_time(key) for kind, key in keys.items()), default=0):
+            metrics.inc(f'rate_limit.{self.name}.shed_local')
+            raise too_many_requests_exception(wait)
+        for kind, key in keys.items():
+            self.buckets[kind].take(key)
+
+        redis_keys = [f'fast_shop:rate:{self.name}:{kind}:{key}' for kind, key in keys.items()]
+        try:
+            wait_ms = await self._script(connect_redis())(
+                keys=redis_keys, args=[int(self.window * 1000), uuid.uuid4().hex, *(self.limits[kind] for kind in keys)]
+            )
+        except RedisError as e:
+            metrics.inc(f'rate_limit.{self.name}.redis_errors')
+            logger.warning('rate limiter fell back to local limits', error=str(e))
+            wait_ms = 0
+        if wait_ms:
+            metrics.inc(f'rate_limit.{self.name}.shed')
+            raise too_many_requests_exception(wait_ms / 1000)
+        metrics.inc(f'rate_limit.{self.name}.allowed')
+
+    def _script(self, redis: Redis) -> AsyncScript:
+        # runs by sha (EVALSHA), the script itself is only sent when redis doesn't know it yet
+        if self._hit is None or self._hit.registered_client is not redis:
+            self._hit = redis.register_script(self.hit_script)
+        return self._hit
+
+
+auth_rate_limiter = RateLimiter(
+    'auth', settings.auth_rate_window, {'phone': settings.auth_rate_per_phone, 'ip': settings.auth_rate_per_ip}
+)
@@ -0,0 +1,120 @@
+import asyncio
+import time
+
+from redis.exceptions import RedisError
+
+from app_infra.app_logger import get_logger
+from app_infra.cache import connect_redis
+from app_infra.metrics import metrics
+from config import settings
+from helpers.bloom import BloomFilter
+
+logger = get_logger()
+
+
+class Revocations:
+    """
+    revoked tokens (jti -> expiry) and sessions (user id -> not_before, their tokens issued earlier are revoked) are
+    kept in two sorted sets in redis for as long as the tokens could still be valid. every worker mirrors them in a
+    bloom filter fed over pub/sub, so a token that was never revoked, nearly all of them, passes without a round trip
+    and redis only settles filter hits
+    """
+
+    tokens_key = 'fast_shop:revoked:tokens'
+    users_key = 'fast_shop:revoked:users'
+    channel = 'fast_shop:revocations'
+
+    def __init__(self):
+        self.bloom = self._new_filter()
+        self.loaded = False  # the filter was loaded from redis at least once
+        self.synced = False  # until then every check goes to redis
+
+    async def revoke_token(self, payload: dict):
+        if 'jti' in payload and payload['exp'] > time.time():
+            await self._revoke(self.tokens_key, 'jti', payload['jti'], payload['exp'])
+
+    async def revoke_user(self, user_id: int):
+        """revokes every token of the user issued until now"""
+        await self._revoke(self.users_key, 'user', user_id, time.time())
+
+    async def is_revoked(self, payload: dict) -> bool:
+        members = [f'user:{payload["sub"]}'] + ([f'jti:{payload["jti"]}'] if 'jti' in payload else [])
+        in_filter = any(member in self.bloom for member in members)
+        if self.synced and not in_filter:
+            metrics.inc('revocation.filter_passes')
+            return False
+        metrics.inc('revocation.redis_checks')
+        try:
+            async with connect_redis().pipeline(transaction=False) as pipe:
+                pipe.zscore(self.users_key, payload['sub'])
+                pipe.zscore(self.tokens_key, payload.get('jti', ''))
+                not_before, revoked = await pipe.execute()
+        except RedisError as e:
+            metrics.inc('revocation.redis_errors')
+            logger.warning('revocation check fell back to the filter', error=str(e))
+            # the last loaded filter has no false negatives, its hits are settled by the setting
+            if self.loaded and not in_filter:
+                return False
+            return settings.revocation_fail_closed
+        if revoked is not None or (not_before is not None and payload.get('iat', 0) < not_before):
+            metrics.inc('revocation.rejected')
+            return True
+        metrics.inc('revocation.redis_passes')
+        return False
+
+    async def listen(self):
+        """keeps the filter of this worker in sync; expired revocations are dropped by rebuilding it now and then"""
+        while True:
+            pubsub = connect_redis().pubsub(ignore_subscribe_messages=True)
+            try:
+                # subscribed before loading, so no revocation can fall in between
+                await pubsub.subscribe(self.channel)
+                rebuild_at = 0
+                while True:
+                    if time.monotonic() >= rebuild_at:
+                        await self._rebuild()
+                        rebuild_at = time.monotonic() + settings.revocation_rebuild_seconds
+                    message = await pubsub.get_message(timeout=1)
+                    if message is not None:
+                        self.bloom.add(message['data'])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning('revocation subscription lost', error=str(e))
+                await asyncio.sleep(1)
+            finally:
+                # we may miss revocations until we subscribe again
+                self.synced = False
+                await pubsub.close()
+
+    async def _revoke(self, key: str, kind: str, value, score: float):
+        member = f'{kind}:{value}'
+        async with connect_redis().pipeline(transaction=True) as pipe:
+            pipe.zadd(key, {value: score}, gt=True)
+            pipe.publish(self.channel, member)
+            await pipe.execute()
+        self.bloom.add(member)
+        metrics.inc('revocation.revoked')
+
+    async def _rebuild(self):
+        """drops the expired revocations and loads the rest into a new filter"""
+        redis = connect_redis()
+        now = time.time()
+        async with redis.pipeline(transaction=False) as pipe:
+            pipe.zremrangebyscore(self.tokens_key, '-inf', now)
+            # tokens issued before a not_before this old have expired
+            pipe.zremrangebyscore(self.users_key, '-inf', now - settings.token_expire_seconds - 1)
+            await pipe.execute()
+        bloom = self._new_filter()
+        for key, kind in ((self.tokens_key, 'jti'), (self.users_key, 'user')):
+            async for value, _ in redis.zscan_iter(key, count=1000):
+                bloom.add(f'{kind}:{value}')
+        self.bloom, self.loaded, self.synced = bloom, True, True
+        metrics.set('revocation.filter_items', bloom.count)
+
+    @staticmethod
+    def _new_filter() -> BloomFilter:
+        return BloomFilter(settings.revocation_filter_capacity, settings.revocation_filter_error_rate)
+
+
+revocations = Revocations()
@@ -1,25 +1,50 @@
 import time
-from typing import Callable
+from typing import Any, Callable
 
 from fastapi.exceptions import RequestValidationError
 from fastapi.routing import APIRoute
 from fastapi import Request, Response
 
 from app_infra.app_logger import get_logger
+from app_infra.metrics import metrics
+from app_infra.query_profiler import profile_queries, QueryBudgetExceeded, QueryProfile
+from app_infra.serialization import fast_serializing
 from config import settings
 
 logger = get_logger()
 
 
 class LogRoute(APIRoute):
+    def __init__(self, path: str, endpoint: Callable[..., Any], **kwargs):
+        response_model = kwargs.get('response_model')
+        if getattr(endpoint, 'trusted_response', False) and settings.fast_serialization and response_model:
+            endpoint = fast_serializing(endpoint, response_model, kwargs.get('status_code'))
+        super().__init__(path, endpoint, **kwargs)
+
     # todo: get_request_body should move to somewhere else and await request.body() should be replace with cheaper code
     #       maybe moving it to helper layer in RequestHelper class would be a good idea
     @staticmethod
     async def get_request_body(request: Request) -> dict | None:
-        if settings.auth_route_prefix not in request.url.path:
+        # only json bodies: uploads are streamed, reading them here would buffer them whole
+        is_json = request.headers.get('content-type', '').startswith('application/json')
+        if settings.auth_route_prefix not in request.url.path and is_json:
             request_body = await request.json() if await request.body() else None
             return request_body
 
+    def check_queries(self, request: Request, profile: QueryProfile):
+        metrics.inc('db.queries', profile.count)
+        metrics.observe('db.request_time', profile.total_time)
+        for statement, count in profile.duplicates.items():
+            if count >= settings.n_plus_one_threshold:
+                logger.warning('possible N+1 query', request_id=request.state.request_id, statement=statement, count=count)
+
+        budget = getattr(self.endpoint, 'query_budget', None)
+        if budget is not None and profile.count > budget:
+            message = f'{self.path} ran {profile.count} queries, budget is {budget}'
+            logger.warning(message, request_id=request.state.request_id)
+            if settings.query_budget_strict:
+                raise QueryBudgetExceeded(message)
+
     def get_route_handler(self) -> Callable:
         original_route_handler = super().get_route_handler()
 
@@ -33,7 +58,8 @@ class LogRoute(APIRoute):
             }
             start_time = time.time()
             try:
-                response = await original_route_handler(request)
+                with profile_queries() as profile:
+                    response = await original_route_handler(request)
 
             # todo: why am i catching exceptions here?! specially when it's only for logging. it must go to exception
             #       layer in app_infra
@@ -48,8 +74,11 @@ class LogRoute(APIRoute):
             process_time = time.time() - start_time
             log_data['process_time'] = process_time
             log_data['status_code'] = response.status_code
-            log_data['response_body'] = response.body.decode()
+            # streaming responses have no body yet, they are sent after this
+            log_data['response_body'] = response.body.decode() if hasattr(response, 'body') else None
+            log_data['db'] = profile.summary()
             logger.info('request log', **log_data)
+            self.check_queries(request, profile)
             return response
 
         return custom_route_handler
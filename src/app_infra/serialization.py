@@ -0,0 +1,91 @@
+import functools
+import inspect
+from operator import attrgetter
+from types import UnionType
+from typing import Any, Callable, Union, get_args, get_origin, get_type_hints
+
+import orjson
+from fastapi import Response
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel
+
+
+class UtcZResponse(ORJSONResponse):
+    """ORJSONResponse writing utc datetimes with a Z, as pydantic does, so trusted and validated responses agree"""
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
+
+
+def dumps(content: Any) -> bytes:
+    return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_UTC_Z)
+
+
+def _identity(value):
+    return value
+
+
+@functools.cache
+def projector(annotation) -> Callable[[Any], Any]:
+    """
+    compiles a function that copies the fields of `annotation` (a response model, a list of them, ...) out of an object
+    into plain data for orjson. nothing is validated: the object is trusted to have the right types already
+    """
+    origin = get_origin(annotation)
+    if origin in (Union, UnionType):
+        args = [a for a in get_args(annotation) if a is not type(None)]
+        if len(args) != 1:
+            return _identity
+        inner = projector(args[0])
+        return _identity if inner is _identity else lambda value: None if value is None else inner(value)
+    if origin is list:
+        inner = projector(get_args(annotation)[0])
+        return list if inner is _identity else lambda values: [inner(v) for v in values]
+    if isinstance(annotation, type) and issubclass(annotation, BaseModel):
+        getters = []
+        hints = get_type_hints(annotation)  # resolves forward references like list["OrderProductOut"]
+        for name in annotation.model_fields:
+            get, project = attrgetter(name), projector(hints[name])
+            getters.append((name, get if project is _identity else lambda obj, get=get, project=project: project(get(obj))))
+        return lambda obj: {name: get(obj) for name, get in getters}
+    return _identity
+
+
+def trusted_response(endpoint):
+    """
+    opts an endpoint into the fast serialization path (see LogRoute): what it returns is dumped straight to orjson
+    through its response_model's projector, skipping fastapi's validation of the response. only for internal objects
+    that already have the shape of the response model
+    """
+    endpoint.trusted_response = True
+    return endpoint
+
+
+def fast_serializing(endpoint: Callable, response_model, status_code: int | None) -> Callable:
+    """wraps a trusted_response endpoint so it returns a ready UtcZResponse"""
+    project = projector(response_model)
+    signature = inspect.signature(endpoint)
+    # we need the response fastapi injects, for headers/status the endpoint sets on it
+    response_param = next((p.name for p in signature.parameters.values() if p.annotation is Response), None)
+    if response_param is None:
+        response_param = '_fast_response'
+        signature = signature.replace(parameters=[
+            *signature.parameters.values(),
+            inspect.Parameter(response_param, inspect.Parameter.KEYWORD_ONLY, annotation=Response),
+        ])
+
+    @functools.wraps(endpoint)
+    async def wrapper(**kwargs):
+        sub_response = kwargs[response_param]
+        if response_param == '_fast_response':
+            del kwargs[response_param]
+        content = await endpoint(**kwargs)
+        if isinstance(content, Response):
+            return content
+        response = UtcZResponse(project(content), status_code=sub_response.status_code or status_code or 200)
+        response.headers.raw.extend(sub_response.headers.raw)
+        return response
+
+    wrapper.__signature__ = signature
+    wrapper.trusted_response = False  # wrapped already, include_router builds the route once more from it
+    return wrapper
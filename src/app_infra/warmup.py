@@ -0,0 +1,110 @@
+import asyncio
+import time
+import uuid
+
+from aredis_om import Migrator
+
+from app_infra.app_logger import get_logger
+from app_infra.cache import connect_redis
+from app_infra.metrics import metrics
+from config import settings
+from data._base import CacheRepo
+from data.product import ProductRepo, ProductCacheRepo
+from db import UnitOfWork
+from model.cache import ProductCache
+
+logger = get_logger()
+
+
+class CacheWarmer:
+    """
+    loads all products into redis, the most ordered ones first, so a deploy on an empty redis (or a flush, or a
+    failover to an empty replica) doesn't send every product request to the database at once
+    """
+
+    # set once the hot set is in redis. it goes away with everything else on a flush, which is how we notice one
+    marker_key = ProductCache.make_key('warm')
+    lock_key = ProductCache.make_key('warmup_lock')
+    extend_lock_script = """
+    if redis.call('get', KEYS[1]) == ARGV[1] then
+        return redis.call('expire', KEYS[1], ARGV[2])
+    end
+    return 0
+    """
+
+    def __init__(self):
+        self.ready = False
+
+    async def keep_warm(self):
+        while True:
+            try:
+                await self.warm_up()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning('cache warm-up failed', error=str(e))
+            await asyncio.sleep(settings.cache_warmup_check_seconds)
+
+    async def warm_up(self, force: bool = False):
+        """warms redis up unless it is warm already (or force). only one worker of the cluster loads, others wait"""
+        redis = connect_redis()
+        while force or not await redis.exists(self.marker_key):
+            token = str(uuid.uuid4())
+            if await redis.set(self.lock_key, token, nx=True, ex=settings.cache_warmup_lock_lease):
+                try:
+                    await self._load(token)
+                finally:
+                    # only our own lock: a warm-up that outlived its lease may have been taken over
+                    await redis.eval(CacheRepo.release_lock_script, 1, self.lock_key, token)
+                break
+            await asyncio.sleep(1)
+        # once ready we stay ready: re-warming after a flush is a reason to be slow, not to leave the load balancer
+        self.ready = True
+
+    async def _load(self, lock_token: str):
+        redis = connect_redis()
+        await Migrator().run()  # a flush drops the search indexes too
+        cache_repo = ProductCacheRepo(redis)
+        semaphore = asyncio.Semaphore(settings.cache_warmup_concurrency)
+        pending: set[asyncio.Task] = set()
+        started, loaded, hot_loaded = time.monotonic(), 0, False
+
+        async def save(chunk):
+            try:
+                # fill, not save: the outbox relay may have cached newer versions meanwhile
+                await cache_repo.fill(*chunk)
+            finally:
+                semaphore.release()
+
+        async def mark_hot_loaded():
+            await asyncio.gather(*pending)
+            await redis.set(self.marker_key, 1)
+            self.ready = True
+            logger.info('cache hot set loaded', products=loaded, seconds=round(time.monotonic() - started, 2))
+
+        async with UnitOfWork() as uow:
+            async for chunk in ProductRepo(uow).stream_by_popularity(settings.cache_warmup_chunk_size):
+                # waiting for a free pipeline slot also stops us from reading ahead of redis
+                await semaphore.acquire()
+                task = asyncio.create_task(save(chunk))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+                loaded += len(chunk)
+                lease = settings.cache_warmup_lock_lease
+                await redis.eval(self.extend_lock_script, 1, self.lock_key, lock_token, lease)
+
+                elapsed = time.monotonic() - started
+                metrics.set('cache_warmup.products', loaded)
+                metrics.set('cache_warmup.products_per_second', loaded / elapsed if elapsed else 0)
+                logger.info('cache warm-up progress', products=loaded, seconds=round(elapsed, 2))
+                if not hot_loaded and loaded >= settings.cache_warmup_hot_size:
+                    await mark_hot_loaded()
+                    hot_loaded = True
+        if not hot_loaded:
+            await mark_hot_loaded()
+        await asyncio.gather(*pending)
+        await cache_repo.mark_complete()
+        logger.info('cache warm-up done', products=loaded, seconds=round(time.monotonic() - started, 2))
+
+
+cache_warmer = CacheWarmer()
@@ -0,0 +1,94 @@
+"""
+compares the cache codecs: redis memory per product and read latency, against the RedisJSON model.
+run from src, against a redis you can write to: python -m benchmarks.cache_codec --products 2000 --info-bytes 4000
+"""
+import argparse
+import asyncio
+import random
+import string
+import time
+
+from app_infra.cache import connect_redis, clean_cache
+from data.product import ProductCacheRepo
+from helpers.codec import make_codec
+from model.model import Product
+
+configs = [
+    ('json', None), ('orjson', None), ('msgpack', None),
+    ('orjson', 'zstd'), ('msgpack', 'zstd'), ('orjson', 'lz4'), ('msgpack', 'lz4'),
+]
+
+
+def make_products(count: int, info_bytes: int) -> list[Product]:
+    words = [''.join(random.choices(string.ascii_lowercase, k=random.randint(3, 10))) for _ in range(500)]
+
+    def text(size):
+        return ' '.join(random.choices(words, k=size // 7))
+
+    return [
+        Product(
+            id=1_000_000_000 + i,  # far from real ids
+            category=random.choice(['mobile', 'laptop', 'headset']),
+            price=random.randint(100, 5000),
+            quantity=random.randint(1, 100),
+            info={'name': text(30), 'description': text(info_bytes // 2), 'specs': {f'spec_{j}': text(40) for j in range(info_bytes // 2 // 50)}},
+        )
+        for i in range(count)
+    ]
+
+
+async def run(products: list[Product], batch: int):
+    redis = connect_redis()
+    pks = [p.id for p in products]
+    print(f'{"codec":<16}{"bytes/key":>12}{"get_many ms":>14}{"decode us":>12}')
+    for name, compression in configs:
+        try:
+            codec = make_codec(name, compression)
+        except ImportError as e:
+            print(f'{name}+{compression}: skipped, {e.name} is not installed')
+            continue
+        repo = type('BenchmarkRepo', (ProductCacheRepo,), {'codec': codec, 'local_cache': None})(redis)
+        for i in range(0, len(products), batch):
+            await repo.save(*products[i:i + batch])
+
+        sample = pks[:200]
+        memory = 0
+        for pk in sample:
+            memory += await redis.memory_usage(repo.key(pk)) or 0
+            if codec is not None:
+                memory += await redis.memory_usage(repo.index_model.make_primary_key(pk)) or 0
+
+        started = time.perf_counter()
+        for i in range(0, len(pks), batch):
+            await repo.get_many(pks[i:i + batch])
+        get_many_ms = (time.perf_counter() - started) * 1000 / (len(pks) / batch)
+
+        # decode alone: what the worker pays per entry, without the network
+        if codec is None:
+            raw = await redis.json().mget([repo.key(pk) for pk in sample], '$')
+            decode = lambda r: repo.model.model_validate(r[0])
+        else:
+            raw = await redis.execute_command('MGET', *(repo.key(pk) for pk in sample), NEVER_DECODE=True)
+            decode = repo.decode
+        started = time.perf_counter()
+        for r in raw:
+            decode(r)
+        decode_us = (time.perf_counter() - started) * 1_000_000 / len(raw)
+
+        label = codec.name if codec else 'json (RedisJSON)'
+        print(f'{label:<16}{memory / len(sample):>12.0f}{get_many_ms:>14.2f}{decode_us:>12.1f}')
+        await repo.delete(*pks)
+    await clean_cache()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--products', type=int, default=2000)
+    parser.add_argument('--info-bytes', type=int, default=4000)
+    parser.add_argument('--batch', type=int, default=100)
+    args = parser.parse_args()
+    asyncio.run(run(make_products(args.products, args.info_bytes), args.batch))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,21 @@
+"""helpers shared by the cpu benchmarks"""
+import time
+from typing import Awaitable, Callable
+
+
+async def measure(call: Callable[[], Awaitable], rounds: int) -> float:
+    """cpu microseconds per call"""
+    started = time.process_time()
+    for _ in range(rounds):
+        await call()
+    return (time.process_time() - started) * 1_000_000 / rounds
+
+
+async def compare(paths: list[tuple[str, Callable[[], Awaitable]]], rounds: int):
+    """prints the cpu time per request of each path, and what it saves against the first one"""
+    baseline = None
+    print(f'{"path":<34}{"us/request":>12}{"saved":>8}')
+    for name, call in paths:
+        took = await measure(call, rounds)
+        baseline = baseline or took
+        print(f'{name:<34}{took:>12.1f}{1 - took / baseline:>8.0%}')
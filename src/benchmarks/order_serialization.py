@@ -0,0 +1,65 @@
+"""
+cpu spent turning a page of GET /order/ into response bytes: fastapi's validation + stdlib json (before), the same with
+orjson (UtcZResponse, the default response class now) and the trusted_response projector path.
+run from src: python -m benchmarks.order_serialization --orders 10 --items 5
+"""
+import argparse
+import asyncio
+from datetime import datetime, UTC
+
+from fastapi.responses import JSONResponse
+from fastapi.routing import serialize_response
+from fastapi.utils import create_response_field
+
+from app_infra.serialization import projector, UtcZResponse
+from benchmarks.common import compare
+from model.model import Order, OrderProduct, OrderOut, Product
+
+
+def make_orders(count: int, items: int) -> list[Order]:
+    now = datetime.now(UTC)
+    product = Product(id=1, category='laptop', price=2000, quantity=10, info={'name': 'samsung', 'ram': '16GB'})
+    return [
+        Order(
+            id=i, address_id=1, status='created', status_date=now, created_at=now, updated_at=now,
+            products=[
+                OrderProduct(id=i * items + j, quantity=1, price=2000, product=product, created_at=now, updated_at=now)
+                for j in range(items)
+            ],
+        )
+        for i in range(count)
+    ]
+
+
+async def run(orders: list[Order], rounds: int):
+    field = create_response_field(name='Response_get_all', type_=list[OrderOut])
+    project = projector(list[OrderOut])
+
+    async def validated(response_class):
+        content = await serialize_response(field=field, response_content=orders, is_coroutine=True)
+        return response_class(content).body
+
+    async def stdlib():
+        return await validated(JSONResponse)
+
+    async def orjson_validated():
+        return await validated(UtcZResponse)
+
+    async def trusted():
+        return UtcZResponse(project(orders)).body
+
+    await compare([('validate + json', stdlib), ('validate + orjson', orjson_validated),
+                   ('trusted_response (projector)', trusted)], rounds)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--orders', type=int, default=10, help='orders per page')
+    parser.add_argument('--items', type=int, default=5, help='line items per order')
+    parser.add_argument('--rounds', type=int, default=2000)
+    args = parser.parse_args()
+    asyncio.run(run(make_orders(args.orders, args.items), args.rounds))
+
+
+if __name__ == '__main__':
+    main()
@@ -10,11 +10,57 @@ class Settings(BaseSettings):
     db_url: str = ''
     secret_key: str
     token_expire_seconds: int = 1800
+    token_cache_size: int = 10_000  # verified tokens remembered per worker, 0 turns the cache off
+    revocation_filter_capacity: int = 100_000  # revocations each worker's bloom filter holds at its error rate
+    revocation_filter_error_rate: float = 0.001
+    revocation_rebuild_seconds: float = 600  # expired revocations leave the filters when they are rebuilt
+    revocation_fail_closed: bool = True  # while redis fails, reject tokens the filter can't clear
+    auth_rate_window: float = 60  # login and signup attempts are limited per phone and per client ip in this window
+    auth_rate_per_phone: int = 5
+    auth_rate_per_ip: int = 30
+    rate_limit_local_keys: int = 100_000  # keys with a token bucket in each worker
+    hash_executor: str = 'thread'  # thread or process; bcrypt releases the gil, so threads use all cores too
+    hash_workers: int = 4
+    hash_queue_size: int = 32  # hashes waiting for a worker; more are rejected with 503
     timezone: tzinfo = pytz.timezone('Asia/Tehran')
     login_path: str = 'auth/login'
     auth_scheme: APIKeyHeader = APIKeyHeader(name='X-API-Key')  # X-API-Key can be any arbitrary name
     auth_route_prefix: str = '/auth'
     redis_url: str = 'redis://localhost:6379'
+    redis_max_connections: int = 100
+    cache_miss_lock: bool = True  # one worker loads a missed key, the others wait for its result in redis
+    cache_miss_lock_lease: float = 2
+    cache_negative_ttl: int = 30  # seconds a missing entity is remembered as missing
+    local_cache_max_bytes: int = 16 * 1024 * 1024  # per worker, per cached model
+    local_cache_ttl: float = 5  # upper bound on how stale a worker's local cache can get
+    user_cache_ttl: int = 3600  # bounds how stale a profile gets should an invalidation be lost
+    cache_codec: str = 'json'  # json (RedisJSON documents), orjson or msgpack (byte strings + an index hash)
+    cache_compression: str | None = None  # zstd or lz4, for the byte codecs
+    cache_compress_min_bytes: int = 512
+    page_cache_ttl: int = 300  # list pages are keyed by catalog version, this only bounds stale stock numbers
+    cache_warmup: bool = True  # load products into redis at startup and whenever redis comes back empty
+    cache_warmup_hot_size: int = 10_000  # the most ordered products, readiness waits for these
+    cache_warmup_chunk_size: int = 500
+    cache_warmup_concurrency: int = 4  # pipelines in flight
+    cache_warmup_check_seconds: float = 30
+    cache_warmup_lock_lease: int = 60
+    outbox_batch_size: int = 500
+    outbox_poll_seconds: float = 1  # the relay is also woken up right after this worker's own writes
+    outbox_lock_lease: float = 10
+    outbox_inline: bool = False  # relay right after the write, in the request (tests)
+    export_chunk_size: int = 1000  # rows per fetch of an export's server side cursor, and per chunk sent
+    import_chunk_size: int = 500  # rows per upsert statement (and transaction) of a bulk import
+    import_max_errors: int = 1000  # row errors listed in an import report, the rest are only counted
+    default_page_size: int = 10
+    max_page_size: int = 100
+    db_echo: bool = False
+    db_replica_urls: list[str] = []  # plain reads of the repos go to these when set
+    replica_sticky_seconds: float = 5  # a client reads from the primary for this long after its writes
+    replica_health_check_seconds: float = 10
+    replica_health_check_timeout: float = 2
+    fast_serialization: bool = True  # trusted_response endpoints skip response validation
+    query_budget_strict: bool = False  # raise instead of logging when an endpoint exceeds its query budget
+    n_plus_one_threshold: int = 5  # same statement this many times in one request is logged as a possible N+1
 
     model_config = SettingsConfigDict(env_file="envs/.env")
 
@@ -1,18 +1,31 @@
+import asyncio
+import itertools
+import json
+import uuid
 from abc import ABC, abstractmethod
-from typing import ClassVar, Iterable
+from datetime import datetime
+from typing import ClassVar, Iterable, Sequence, Callable, Awaitable, AsyncIterator
 
-from aredis_om import JsonModel
-from fastapi import Depends
+from aredis_om import JsonModel, HashModel, NotFoundError
+from aredis_om.model.encoders import jsonable_encoder
+from fastapi import Depends, HTTPException, status
 from multimethod import multimethod
-from redis import Redis
-from sqlalchemy import update, select, delete, Delete, Update, Insert
+from redis.asyncio import Redis
+from sqlalchemy import update, select, delete, insert, func, bindparam, Delete, Update, Insert, Select
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.exc import NoResultFound
-from sqlalchemy.ext.asyncio import AsyncSession
 from sqlmodel import SQLModel
 
-from app_infra.dependencies import get_db_session, get_redis
-from db import async_session_maker
+from app_infra.cache import invalidation_channel
+from app_infra.dependencies import get_unit_of_work, get_redis
+from app_infra.metrics import metrics
+from config import settings
+from data._statements import statement_cache
+from db import UnitOfWork
+from helpers.codec import Codec, make_codec
 from helpers.exceptions import entity_not_found_exception
+from helpers.local_cache import LocalCache
+from helpers.singleflight import SingleFlight
 from model.model import Base
 
 
@@ -27,12 +40,16 @@ class RepoABC[T](ABC):
     async def get_one(self, **where):
         raise NotImplementedError
 
+    @abstractmethod
+    async def get_current(self, **where):
+        raise NotImplementedError
+
     @abstractmethod
     async def get_by_ids(self, ids: list):
         raise NotImplementedError
 
     @abstractmethod
-    async def get(self, limit, offset, **where):
+    async def get(self, limit, offset, after, **where):
         raise NotImplementedError
 
     @abstractmethod
@@ -51,42 +68,105 @@ class RepoABC[T](ABC):
     async def in_tran(self, *objects):
         raise NotImplementedError
 
+    @abstractmethod
+    async def bulk_create(self, rows, chunk_size):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def bulk_upsert(self, rows, conflict_keys, chunk_size):
+        raise NotImplementedError
+
 
 class Repo(RepoABC):
     model: ClassVar[Base] = Base
 
-    def __init__(self, session: AsyncSession = Depends(get_db_session)):
-        self.session = session if isinstance(session, AsyncSession) else async_session_maker()
+    def __init__(self, uow: UnitOfWork = Depends(get_unit_of_work)):
+        self.uow = uow if isinstance(uow, UnitOfWork) else UnitOfWork()
+
+    @property
+    def session(self):
+        return self.uow.session
+
+    @property
+    def reader(self):
+        return self.uow.reader
+
+    def filter_by(self, where: dict, exists: bool = False) -> Select:
+        """returns the cached `select(model).filter_by(...)` (or its `exists` form) for the keys of `where`. the
+        statement has to be executed with `where` as its parameters"""
+        def build(**filters):
+            if exists:
+                return select(select(self.model.id).filter_by(**filters).exists())
+            return select(self.model).filter_by(**filters)
+
+        if None in where.values():
+            # filter_by renders `IS NULL` for None, which a bound parameter can't express
+            return build(**where)
+        return statement_cache.get(
+            (self.model, exists, frozenset(where)),
+            lambda: build(**{k: bindparam(k) for k in sorted(where)})
+        )
+
+    async def stream(self, stmt: Select, chunk_size: int = 500) -> AsyncIterator[Sequence]:
+        """
+        yields the entities of `stmt` in chunks, fetched from a server side cursor. a chunk is expunged when the next one
+        is requested, so memory stays at one chunk whatever the size of the result. use a dedicated unit of work
+        """
+        session = self.reader
+        result = await session.stream_scalars(stmt, execution_options={'yield_per': chunk_size})
+        try:
+            async for chunk in result.partitions():
+                yield chunk
+                for entity in chunk:
+                    session.expunge(entity)
+        finally:
+            await result.close()
+
+    def created_between(self, stmt: Select, start: datetime | None, end: datetime | None) -> Select:
+        if start is not None:
+            stmt = stmt.where(self.model.created_at >= start)
+        if end is not None:
+            stmt = stmt.where(self.model.created_at < end)
+        return stmt
 
     async def get_one(self, **where):
+        return await self._get_one(self.reader, where)
+
+    async def get_current(self, **where):
+        """get_one from the primary, for filling caches: a lagging replica could return a row older than a cached one"""
+        return await self._get_one(self.session, where)
+
+    async def _get_one(self, session, where: dict):
         try:
-            stmt = select(self.model).filter_by(**where)
-            async with self.session as s:
-                return (await s.scalars(stmt)).one()
+            stmt = self.filter_by(where)
+            return (await session.scalars(stmt, where)).one()
         except NoResultFound:
             raise entity_not_found_exception
 
     async def get_by_ids(self, ids: list[int]) -> Iterable[model]:
         from sqlmodel import col
-        stmt = select(self.model).where(col(self.model.id).in_(ids))
-        async with self.session as s:
-            return (await s.scalars(stmt)).all()
-
-    async def get(self, limit=10, offset=0, **where):
-        stmt = select(self.model).where(**where).offset(offset).limit(limit)
-        async with self.session as s:
-            return (await s.scalars(stmt)).all()
+        stmt = statement_cache.get(
+            (self.model, 'ids'),
+            lambda: select(self.model).where(col(self.model.id).in_(bindparam('ids', expanding=True)))
+        )
+        return (await self.reader.scalars(stmt, {'ids': ids})).all()
+
+    async def get(self, limit=10, offset=0, after: int | None = None, **where):
+        """returns a page sorted by id; pass `after` (the last id of the previous page) to seek instead of offset"""
+        stmt = select(self.model).filter_by(**where).order_by(self.model.id).limit(limit)
+        if after is not None:
+            stmt = stmt.where(self.model.id > after)
+        else:
+            stmt = stmt.offset(offset)
+        return (await self.reader.scalars(stmt)).all()
 
     async def find_one(self, **where) -> model:
-        stmt = select(self.model).filter_by(**where)
-        async with self.session:
-            return await self.session.scalar(stmt)
+        stmt = self.filter_by(where)
+        return await self.reader.scalar(stmt, where)
 
     async def exists(self, **where) -> bool:
-        # stmt = exists(1).where(*where).select()  # second way
-        stmt = select(self.model.id).filter_by(**where).exists()
-        async with self.session as s:
-            return await s.scalar(select(stmt))
+        stmt = self.filter_by(where, exists=True)
+        return await self.reader.scalar(stmt, where)
 
     def update(self, where: dict, values: dict) -> Update:
         stmt = update(self.model).filter_by(**where).values(**values)
@@ -97,12 +177,55 @@ class Repo(RepoABC):
         return stmt
 
     async def in_tran(self, *objects: SQLModel | Insert | Update | Delete):
-        async with self.session.begin():
+        async with self.uow.transaction() as session:
             for obj in objects:
                 if isinstance(obj, SQLModel):
-                    self.session.add(obj)
+                    session.add(obj)
                 else:
-                    await self.session.execute(obj)
+                    await session.execute(obj)
+            # assigns ids even when this joins an outer transaction
+            await session.flush()
+
+    async def bulk_create(self, rows: Iterable[SQLModel | dict], chunk_size: int = 500) -> list[model]:
+        """inserts rows with one multi-row `INSERT ... RETURNING` per chunk and returns the inserted models"""
+        return await self._bulk_insert(rows, chunk_size)
+
+    async def bulk_upsert(
+        self, rows: Iterable[SQLModel | dict], conflict_keys: Sequence[str], chunk_size: int = 500
+    ) -> list[model]:
+        """like bulk_create, but rows colliding on conflict_keys (which must be a unique constraint) update the
+        existing row"""
+        return await self._bulk_insert(rows, chunk_size, conflict_keys)
+
+    async def _bulk_insert(self, rows, chunk_size, conflict_keys=None) -> list[model]:
+        models = []
+        async with self.uow.transaction() as session:
+            # chunks keep the bound parameters of a statement under the driver limits (32k for asyncpg)
+            for chunk in itertools.batched(map(self._values, rows), chunk_size):
+                if conflict_keys is None:
+                    stmt = insert(self.model)
+                else:
+                    stmt = self._upsert(set().union(*chunk), conflict_keys)
+                # returning the whole entity hydrates server defaults (id, created_at, updated_at, ...) in the same
+                # statement, so the models can go straight to a cache repo
+                stmt = stmt.returning(self.model, sort_by_parameter_order=True)
+                result = await session.scalars(stmt, chunk, execution_options={'populate_existing': True})
+                models += result.all()
+        return models
+
+    def _upsert(self, columns: set[str], conflict_keys: Sequence[str]) -> Insert:
+        dialect_insert = {'postgresql': postgresql.insert, 'sqlite': sqlite.insert}[self.session.bind.dialect.name]
+        stmt = dialect_insert(self.model)
+        values = {c: stmt.excluded[c] for c in columns if c not in conflict_keys}
+        # ON CONFLICT DO UPDATE does not run python side `onupdate`s
+        values['updated_at'] = func.now()
+        return stmt.on_conflict_do_update(index_elements=conflict_keys, set_=values)
+
+    @staticmethod
+    def _values(row: SQLModel | dict) -> dict:
+        if isinstance(row, dict):
+            return row
+        return row.model_dump(exclude_unset=True, exclude={'id', 'created_at', 'updated_at'})
 
 
 class CacheRepoABC(ABC):
@@ -111,13 +234,29 @@ class CacheRepoABC(ABC):
         raise NotImplementedError
 
     @abstractmethod
-    async def delete(self, pk):
+    async def get_many(self, pks):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get_or_load(self, pk, load):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get_version(self, pk):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def delete(self, *pks):
         raise NotImplementedError
 
     @abstractmethod
     async def save(self, *objects):
         raise NotImplementedError
 
+    @abstractmethod
+    async def fill(self, *objects):
+        raise NotImplementedError
+
     @abstractmethod
     async def all(self, offset: int, limit: int):
         raise NotImplementedError
@@ -125,20 +264,220 @@ class CacheRepoABC(ABC):
 
 class CacheRepo(CacheRepoABC):
     model = JsonModel
-
+    local_cache: ClassVar[LocalCache | None] = None  # optional in-process layer in front of redis
+
+    # without a codec (settings.cache_codec = 'json') entries are `model` RedisJSON documents, indexed as they are.
+    # with one they are encoded byte strings, and their searchable fields are copied to an `index_model` hash
+    codec: ClassVar[Codec | None] = make_codec(
+        settings.cache_codec, settings.cache_compression, settings.cache_compress_min_bytes
+    )
+    index_model: ClassVar[type[HashModel] | None] = None
+
+    single_flight = SingleFlight()
+    release_lock_script = """
+    if redis.call('get', KEYS[1]) == ARGV[1] then
+        return redis.call('del', KEYS[1])
+    end
+    return 0
+    """
+    # writes an entry only where there is none, so a fill on a miss can't replace what the outbox relay wrote since
+    # KEYS: entry, versions hash, missing marker[, index hash]; ARGV: json or raw, entry, pk, updated_at, then the
+    # fields and values of the index hash
+    fill_script = """
+    local stored
+    if ARGV[1] == 'json' then
+        stored = redis.call('JSON.SET', KEYS[1], '$', ARGV[2], 'NX')
+    else
+        stored = redis.call('SET', KEYS[1], ARGV[2], 'NX')
+    end
+    if not stored then
+        return 0
+    end
+    if ARGV[4] ~= '' then
+        redis.call('HSETNX', KEYS[2], ARGV[3], ARGV[4])
+    end
+    redis.call('DEL', KEYS[3])
+    if KEYS[4] then
+        redis.call('HSET', KEYS[4], unpack(ARGV, 5))
+    end
+    return 1
+    """
+
+    # the models are bound to the shared redis client once, in app_infra.cache.connect_redis
     def __init__(self, redis_conn: Redis = Depends(get_redis)):
-        self.model.Meta.database = redis_conn
+        self.redis = redis_conn if isinstance(redis_conn, Redis) else get_redis()
+
+    @property
+    def search_model(self) -> type[JsonModel | HashModel]:
+        """the model to run redisearch queries on, see `resolve`"""
+        return self.model if self.codec is None else self.index_model
+
+    def key(self, pk) -> str:
+        if self.codec is None:
+            return self.model.make_primary_key(pk)
+        # the codec is part of the key, so entries written with another codec are never misread
+        return self.model.make_key(f'{self.codec.name}:{pk}')
+
+    def decode(self, raw: bytes) -> model:
+        return self.model.model_validate(self.codec.decode(raw))
+
+    @property
+    def versions_key(self) -> str:
+        """a hash of pk -> updated_at of the cached entities, for conditional requests"""
+        return self.model.make_key('versions')
+
+    async def get_version(self, pk: int) -> datetime | None:
+        """updated_at of the cached entity, without reading the entity from redis"""
+        if self.local_cache is not None and (cached := self.local_cache.get(self.model.make_primary_key(pk))):
+            return cached.updated_at
+        version = await self.redis.hget(self.versions_key, str(pk))
+        return datetime.fromisoformat(version) if version else None
 
     async def get(self, pk: int) -> model:
-        return await self.model.get(pk)
-
-    async def delete(self, pk: int):
-        await self.model.delete(pk)
+        if self.codec is None:
+            return await self.model.get(pk)
+        raw = await self.redis.execute_command('GET', self.key(pk), NEVER_DECODE=True)
+        if raw is None:
+            raise NotFoundError
+        return self.decode(raw)
+
+    async def get_many(self, pks: Sequence[int]) -> list[model | None]:
+        """one (JSON.)MGET for all pks, None for the ones not cached"""
+        if not pks:
+            return []
+        keys = [self.key(pk) for pk in pks]
+        if self.codec is None:
+            documents = await self.redis.json().mget(keys, '$')
+            return [self.model.model_validate(d[0]) if d else None for d in documents]
+        return [self.decode(raw) if raw is not None else None
+                for raw in await self.redis.execute_command('MGET', *keys, NEVER_DECODE=True)]
+
+    async def resolve(self, found: list) -> list[model]:
+        """turns the results of a `search_model` query into cached models"""
+        if self.codec is None:
+            return found
+        return [m for m in await self.get_many([f.id for f in found]) if m is not None]
+
+    async def get_or_load(self, pk: int, load: Callable[[], Awaitable[SQLModel]]) -> model:
+        """
+        read-through get. on a miss only one caller per process (and, with the miss lock, per cluster) runs `load`,
+        the others get its result. 404s of `load` are cached for settings.cache_negative_ttl seconds
+        """
+        key = self.model.make_primary_key(pk)
+        if self.local_cache is None:
+            return await self.single_flight.do(key, lambda: self._get_or_load(pk, load))
+
+        if (cached := self.local_cache.get(key)) is not None:
+            return cached
+        generation = self.local_cache.generation
+        cached = await self.single_flight.do(key, lambda: self._get_or_load(pk, load))
+        self.local_cache.set(key, cached, len(cached.model_dump_json()), generation)
+        return cached
+
+    async def _get_or_load(self, pk: int, load: Callable[[], Awaitable[SQLModel]]) -> model:
+        if (cached := await self._get_cached(pk)) is not None:
+            metrics.inc(f'{self.model.__name__}.hits')
+            return cached
+        metrics.inc(f'{self.model.__name__}.misses')
+
+        lock_key, token = self.model.make_key(f'lock:{pk}'), str(uuid.uuid4())
+        if settings.cache_miss_lock:
+            if not await self.redis.set(lock_key, token, nx=True, px=int(settings.cache_miss_lock_lease * 1000)):
+                # another worker is loading it, wait for its result until the lease runs out
+                for _ in range(int(settings.cache_miss_lock_lease / 0.05)):
+                    await asyncio.sleep(0.05)
+                    if (cached := await self._get_cached(pk)) is not None:
+                        return cached
+        try:
+            obj = await load()
+            # the waiters find the entry as soon as the lock is gone
+            await self.fill(obj)
+        except HTTPException as e:
+            if e.status_code == status.HTTP_404_NOT_FOUND:
+                await self.redis.set(self.model.make_key(f'missing:{pk}'), 1, ex=settings.cache_negative_ttl)
+            raise
+        finally:
+            if settings.cache_miss_lock:
+                await self.redis.eval(self.release_lock_script, 1, lock_key, token)
+        return self.to_cache(obj)
+
+    async def _get_cached(self, pk: int) -> model | None:
+        """the cached model, None on a miss. raises entity_not_found_exception when pk is known to be missing"""
+        async with self.redis.pipeline(transaction=False) as pipe:
+            if self.codec is None:
+                pipe.json().get(self.key(pk))
+            else:
+                pipe.execute_command('GET', self.key(pk), NEVER_DECODE=True)
+            pipe.exists(self.model.make_key(f'missing:{pk}'))
+            document, missing = await pipe.execute()
+        if missing:
+            raise entity_not_found_exception
+        if document is None:
+            return None
+        return self.model.model_validate(document) if self.codec is None else self.decode(document)
+
+    def to_cache(self, obj: SQLModel) -> model:
+        return self.model(**obj.model_dump(), pk=str(obj.id))
+
+    async def delete(self, *pks: int):
+        if not pks:
+            return
+        keys = [self.model.make_primary_key(pk) for pk in pks]
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.delete(*keys)
+            pipe.hdel(self.versions_key, *map(str, pks))
+            if self.codec is not None:
+                pipe.delete(*(self.key(pk) for pk in pks))
+                if self.index_model is not None:
+                    pipe.delete(*(self.index_model.make_primary_key(pk) for pk in pks))
+            pipe.publish(invalidation_channel, json.dumps(keys))
+            await pipe.execute()
+
+    async def fill(self, *objects: SQLModel):
+        """caches the objects that aren't cached already; `save` is for writers, which always replace"""
+        if not objects:
+            return
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for o in objects:
+                pipe.eval(self.fill_script, *self._fill_arguments(o))
+            await pipe.execute()
+
+    def _fill_arguments(self, obj: SQLModel) -> list:
+        cached = self.to_cache(obj)
+        keys = [self.key(obj.id), self.versions_key, self.model.make_key(f'missing:{obj.id}')]
+        version = cached.updated_at.isoformat() if cached.updated_at is not None else ''
+        if self.codec is None:
+            args = ['json', cached.json(), obj.id, version]
+        else:
+            args = ['raw', self.codec.encode(cached.model_dump(mode='json')), obj.id, version]
+            if self.index_model is not None:
+                index = self.index_model(**cached.model_dump(include=set(self.index_model.model_fields)))
+                keys.append(index.key())
+                document = {k: v for k, v in jsonable_encoder(index.dict()).items() if v is not None}
+                args += itertools.chain.from_iterable(document.items())
+        return [len(keys), *keys, *args]
 
     async def save(self, *objects: SQLModel):
-        for o in objects:
-            cache = self.model(**o.model_dump(), pk=str(o.id))
-            await cache.save()
+        if not objects:
+            return
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for o in objects:
+                cached = self.to_cache(o)
+                if cached.updated_at is not None:
+                    pipe.hset(self.versions_key, str(o.id), cached.updated_at.isoformat())
+                if self.codec is None:
+                    await cached.save(pipeline=pipe)
+                    continue
+                pipe.set(self.key(o.id), self.codec.encode(cached.model_dump(mode='json')))
+                if self.index_model is not None:
+                    fields = cached.model_dump(include=set(self.index_model.model_fields))
+                    await self.index_model(**fields).save(pipeline=pipe)
+            # forget earlier 404s of these pks
+            pipe.delete(*(self.model.make_key(f'missing:{o.id}') for o in objects))
+            pipe.publish(invalidation_channel, json.dumps([self.model.make_primary_key(o.id) for o in objects]))
+            await pipe.execute()
 
     async def all(self, offset: int = 0, limit: int = 100):
-        return await self.model.find().page(offset=offset, limit=limit)
+        # cached models must have a sortable `id` index, so pages come in the same order as those of the sql repos
+        model = self.search_model
+        return await self.resolve(await model.find().sort_by('id').page(offset=offset, limit=limit))
@@ -0,0 +1,32 @@
+from typing import Callable
+
+from sqlalchemy import Executable
+
+from app_infra.metrics import metrics
+
+
+class StatementCache:
+    """
+    keeps one statement per query shape (model, kind of query, set of filter keys). statements use bound parameters
+    named after the filter keys, so they are constructed once per process and their sqlalchemy cache key (and with it
+    the compiled sql) is computed once as well
+    """
+
+    def __init__(self):
+        self._statements: dict[tuple, Executable] = {}
+
+    def get(self, key: tuple, build: Callable[[], Executable]) -> Executable:
+        try:
+            stmt = self._statements[key]
+            metrics.inc('statement_cache.hits')
+        except KeyError:
+            stmt = self._statements[key] = build()
+            metrics.inc('statement_cache.misses')
+            metrics.set('statement_cache.size', len(self._statements))
+        return stmt
+
+    def __len__(self):
+        return len(self._statements)
+
+
+statement_cache = StatementCache()
@@ -1,11 +1,14 @@
 from abc import ABC, abstractmethod
+from datetime import datetime
+from typing import AsyncIterator, Sequence
 
-from sqlalchemy import select
-from sqlalchemy.orm import joinedload
+from sqlalchemy import select, func, Update
+from sqlalchemy.orm import selectinload
 
 from data._base import RepoABC, Repo
-from helpers.exceptions import entity_not_found_exception
-from model.model import Order, Address, OrderProduct
+from helpers.exceptions import entity_not_found_exception, insufficient_stock_exception
+from model.model import Order, Address, OrderProduct, Product
+from model.schema import OrderExportFilter
 
 
 class OrderRepoABC(RepoABC, ABC):
@@ -14,33 +17,89 @@ class OrderRepoABC(RepoABC, ABC):
         raise NotImplementedError
 
     @abstractmethod
-    async def get(self, limit, offset, user_id):
+    async def get_version(self, pk, user_id):
+        raise NotImplementedError
+
+    @abstractmethod
+    def version_of(self, order):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get(self, limit, offset, after, user_id):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def create(self, order, reservation):
+        raise NotImplementedError
+
+    @abstractmethod
+    def stream_export(self, filters, chunk_size):
         raise NotImplementedError
 
 
 class OrderRepo(Repo, OrderRepoABC):
     model = Order
 
+    # line items and their products are loaded with one `IN` query each (instead of joining them into the order rows),
+    # so limit/offset count orders and a page costs 3 round trips no matter how many items the orders have
+    graph_options = selectinload(Order.products).selectinload(OrderProduct.product)
+
+    @staticmethod
+    def user_orders(user_id):
+        return select(Order).join(Address, Order.address_id == Address.id).where(Address.user_id == user_id)
+
     async def get_one(self, pk, user_id) -> Order:
-        stmt = (
-            select(Order).
-            where(Order.id == pk, Address.user_id == user_id).
-            options(joinedload(Order.products).joinedload(OrderProduct.product))
-        )
-        async with self.session as session:
-            order = await session.scalar(stmt)
+        stmt = self.user_orders(user_id).where(Order.id == pk).options(self.graph_options)
+        order = await self.reader.scalar(stmt)
         if not order:
             raise entity_not_found_exception
         return order
 
-    async def get(self, limit, offset, user_id) -> list[Order]:
-
+    async def get_version(self, pk, user_id) -> datetime | None:
+        """
+        the latest updated_at of the order, its line items and their products (whose category and info are part of
+        OrderOut), for revalidating it without loading them. see version_of
+        """
         stmt = (
-            select(Order).where(Address.user_id == user_id).offset(offset).limit(limit).
-            options(joinedload(Order.products).joinedload(OrderProduct.product))
+            self.user_orders(user_id).
+            outerjoin(OrderProduct, OrderProduct.order_id == Order.id).
+            outerjoin(Product, Product.id == OrderProduct.product_id).
+            with_only_columns(Order.updated_at, func.max(OrderProduct.updated_at), func.max(Product.updated_at)).
+            where(Order.id == pk).
+            group_by(Order.id, Order.updated_at)
         )
-        async with self.session as session:
-            orders = (await session.scalars(stmt)).unique().all()
+        row = (await self.reader.execute(stmt)).first()
+        return max((v for v in row if v is not None), default=None) if row else None
+
+    @staticmethod
+    def version_of(order: Order) -> datetime | None:
+        """get_version of an order loaded with its line items and products"""
+        versions = [order.updated_at]
+        for line in order.products or []:
+            versions += [line.updated_at, line.product and line.product.updated_at]
+        return max((v for v in versions if v is not None), default=None)
+
+    async def get(self, limit, offset, after, user_id) -> list[Order]:
+        stmt = self.user_orders(user_id).order_by(Order.id).limit(limit).options(self.graph_options)
+        stmt = stmt.where(Order.id > after) if after is not None else stmt.offset(offset)
+        orders = (await self.reader.scalars(stmt)).all()
         return orders
 
+    def stream_export(self, filters: OrderExportFilter, chunk_size: int = 1000) -> AsyncIterator[Sequence[Order]]:
+        """orders of all users with their line items, in chunks; the items are loaded with one query per chunk"""
+        stmt = select(Order).order_by(Order.id).options(self.graph_options)
+        stmt = self.created_between(stmt, filters.created_from, filters.created_to)
+        if filters.status is not None:
+            stmt = stmt.where(Order.status == filters.status.value)
+        return self.stream(stmt, chunk_size)
 
+    async def create(self, order: Order, reservation: Update) -> Order:
+        """runs the stock `reservation` (see ProductRepo.reserve) and inserts the order in one transaction"""
+        async with self.uow.transaction() as session:
+            prices = dict((await session.execute(reservation)).all())
+            if len(prices) < len({p.product_id for p in order.products}):
+                raise insufficient_stock_exception
+            for p in order.products:
+                p.price = prices[p.product_id]
+            session.add(order)
+        return order
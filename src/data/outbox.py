@@ -0,0 +1,41 @@
+from abc import ABC, abstractmethod
+from typing import Iterable
+
+from sqlalchemy import select, insert, delete
+from sqlmodel import col
+
+from data._base import RepoABC, Repo
+from model.enums import CacheChange
+from model.model import CacheOutbox
+
+
+class OutboxRepoABC(RepoABC, ABC):
+    @abstractmethod
+    async def add(self, change, ids):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def next_batch(self, limit):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def remove(self, ids):
+        raise NotImplementedError
+
+
+class OutboxRepo(Repo, OutboxRepoABC):
+    model = CacheOutbox
+
+    async def add(self, change: CacheChange, ids: Iterable[int]):
+        """records the change of these entities; call it in the transaction that changes them"""
+        rows = [{'change': change.value, 'entity_id': pk} for pk in ids]
+        if rows:
+            await self.in_tran(insert(CacheOutbox).values(rows))
+
+    async def next_batch(self, limit: int) -> list[CacheOutbox]:
+        # always the primary, a replica may not have the rows yet
+        stmt = select(CacheOutbox).order_by(CacheOutbox.id).limit(limit)
+        return (await self.session.scalars(stmt)).all()
+
+    async def remove(self, ids: list[int]):
+        await self.in_tran(delete(CacheOutbox).where(col(CacheOutbox.id).in_(ids)))
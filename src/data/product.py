@@ -1,21 +1,194 @@
-from abc import ABC
+import hashlib
+import json
+from abc import ABC, abstractmethod
+from typing import AsyncIterator, Sequence
 
+from sqlalchemy import update, case, select, func, Update
+from sqlmodel import col
+
+from config import settings
 from data._base import RepoABC, Repo, CacheRepo, CacheRepoABC
-from model.cache import ProductCache
-from model.model import Product
+from helpers.local_cache import LocalCache
+from helpers.pagination import Page
+from model.cache import ProductCache, ProductIndex
+from model.model import Product, OrderProduct
+from model.schema import ProductFilter, ProductExportFilter
 
 
 class ProductRepoABC(RepoABC, ABC):
-    pass
+    @abstractmethod
+    def reserve(self, quantities: dict[int, int]):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def search(self, filters: ProductFilter, limit: int, offset: int):
+        raise NotImplementedError
+
+    @abstractmethod
+    def stream_by_popularity(self, chunk_size: int):
+        raise NotImplementedError
+
+    @abstractmethod
+    def stream_export(self, filters: ProductExportFilter, chunk_size: int):
+        raise NotImplementedError
 
 
 class ProductRepo(Repo, ProductRepoABC):
     model = Product
 
+    def reserve(self, quantities: dict[int, int]) -> Update:
+        """
+        returns a single conditional update that takes `quantities` ({product id: quantity}) out of stock and returns
+        (id, price) of the products it reserved. a product missing from the result is unknown or short of stock, and
+        the caller must roll back. concurrent reservations serialize on the row locks, so stock never goes negative
+        """
+        quantity = case(quantities, value=Product.id)
+        return (
+            update(Product).
+            where(col(Product.id).in_(quantities), Product.quantity >= quantity).
+            values(quantity=Product.quantity - quantity).
+            returning(Product.id, Product.price).
+            execution_options(synchronize_session=False)
+        )
+
+    async def search(self, filters: ProductFilter, limit: int = 10, offset: int = 0) -> list[Product]:
+        """sql counterpart of ProductCacheRepo.search, for when redis is unavailable"""
+        stmt = select(Product)
+        if filters.category is not None:
+            stmt = stmt.where(Product.category == filters.category)
+        if filters.min_price is not None:
+            stmt = stmt.where(Product.price >= filters.min_price)
+        if filters.max_price is not None:
+            stmt = stmt.where(Product.price <= filters.max_price)
+        if filters.in_stock:
+            stmt = stmt.where(Product.quantity > 0)
+        if filters.q:
+            name = func.lower(Product.info['name'].as_string())
+            stmt = stmt.where(name.contains(filters.q.lower(), autoescape=True))
+        sort_column = getattr(Product, filters.sort.value.lstrip('-'))
+        if filters.sort.value.startswith('-'):
+            sort_column = sort_column.desc()
+        stmt = stmt.order_by(sort_column, Product.id).limit(limit).offset(offset)
+        return (await self.reader.scalars(stmt)).all()
+
+    async def stream_by_popularity(self, chunk_size: int = 500) -> AsyncIterator[Sequence[Product]]:
+        """all products, most ordered first, in chunks fetched from a server side cursor"""
+        ordered = (
+            select(OrderProduct.product_id, func.sum(OrderProduct.quantity).label('ordered')).
+            group_by(OrderProduct.product_id).
+            subquery()
+        )
+        stmt = (
+            select(Product).
+            outerjoin(ordered, ordered.c.product_id == Product.id).
+            order_by(func.coalesce(ordered.c.ordered, 0).desc(), Product.id)
+        )
+        async for chunk in self.stream(stmt, chunk_size):
+            yield chunk
+
+    def stream_export(self, filters: ProductExportFilter, chunk_size: int = 1000) -> AsyncIterator[Sequence[Product]]:
+        stmt = self.created_between(select(Product).order_by(Product.id), filters.created_from, filters.created_to)
+        if filters.category is not None:
+            stmt = stmt.where(Product.category == filters.category)
+        return self.stream(stmt, chunk_size)
+
 
 class ProductCacheRepoABC(CacheRepoABC, ABC):
-    pass
+    @abstractmethod
+    async def search(self, filters: ProductFilter, limit: int, offset: int):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get_page(self, kind: str, params: dict):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get_page_etag(self, kind: str, params: dict):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def save_page(self, kind: str, params: dict, version: str, page: Page):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def bump_catalog_version(self):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def is_complete(self):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def mark_complete(self):
+        raise NotImplementedError
 
 
 class ProductCacheRepo(CacheRepo, ProductCacheRepoABC):
     model = ProductCache
+    index_model = ProductIndex
+    local_cache = LocalCache('product', settings.local_cache_max_bytes, settings.local_cache_ttl)
+
+    # a list page is stored with the catalog version it was built for and is only served while that version is
+    # current, so bumping the version invalidates all pages at once without touching any of them
+    catalog_version_key = ProductCache.make_key('catalog_version')
+    # set once a warm-up has loaded every product; from then on writes keep the cache (and its index) complete. it
+    # goes away on a flush, like the rest
+    complete_key = ProductCache.make_key('complete')
+
+    async def search(self, filters: ProductFilter, limit: int = 10, offset: int = 0) -> list[ProductCache]:
+        """runs entirely on the redisearch index of ProductCache (or ProductIndex, with a byte codec)"""
+        model = self.search_model
+        expressions = []
+        if filters.category is not None:
+            expressions.append(model.category == filters.category)
+        if filters.min_price is not None:
+            expressions.append(model.price >= filters.min_price)
+        if filters.max_price is not None:
+            expressions.append(model.price <= filters.max_price)
+        if filters.in_stock:
+            expressions.append(model.quantity > 0)
+        if filters.q:
+            expressions.append(model.name % filters.q)
+        query = model.find(*expressions).sort_by(filters.sort.value)
+        return await self.resolve(await query.page(offset=offset, limit=limit))
+
+    async def get_page(self, kind: str, params: dict) -> tuple[str, Page | None]:
+        """returns the current catalog version and the page cached for it (or None), in one round trip"""
+        version, (page_version, body, cursor, etag) = await self._read_page(kind, params, 'body', 'next_cursor', 'etag')
+        return version, Page(body, cursor or None, etag or '') if body is not None and page_version == version else None
+
+    async def get_page_etag(self, kind: str, params: dict) -> str | None:
+        """the etag of the current page, without transferring the page"""
+        version, (page_version, etag) = await self._read_page(kind, params, 'etag')
+        return etag if page_version == version else None
+
+    async def save_page(self, kind: str, params: dict, version: str, page: Page):
+        key = self._page_key(kind, params)
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.hset(key, mapping={
+                'version': version, 'body': page.body, 'next_cursor': page.next_cursor or '', 'etag': page.etag,
+            })
+            pipe.expire(key, settings.page_cache_ttl)
+            await pipe.execute()
+
+    async def _read_page(self, kind: str, params: dict, *fields: str) -> tuple[str, list]:
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.get(self.catalog_version_key)
+            pipe.hmget(self._page_key(kind, params), 'version', *fields)
+            version, page = await pipe.execute()
+        return version or '0', page
+
+    async def bump_catalog_version(self):
+        await self.redis.incr(self.catalog_version_key)
+
+    async def is_complete(self) -> bool:
+        """whether every product is cached, so searching the index finds all matches"""
+        return bool(await self.redis.exists(self.complete_key))
+
+    async def mark_complete(self):
+        await self.redis.set(self.complete_key, 1)
+
+    @staticmethod
+    def _page_key(kind: str, params: dict) -> str:
+        digest = hashlib.sha1(json.dumps(params, sort_keys=True, default=str).encode()).hexdigest()
+        return ProductCache.make_key(f'page:{kind}:{digest}')
@@ -1,9 +1,21 @@
-from abc import ABC
+import json
+from abc import ABC, abstractmethod
+from typing import Awaitable, Callable
 
+from fastapi import Depends
+from redis.asyncio import Redis
+from redis.exceptions import RedisError
 from sqlalchemy import select
 
+from app_infra.cache import invalidation_channel
+from app_infra.dependencies import get_redis
+from app_infra.metrics import metrics
+from app_infra.serialization import projector, dumps
+from config import settings
 from data._base import RepoABC, Repo
-from model.model import User
+from helpers.local_cache import LocalCache
+from helpers.singleflight import SingleFlight
+from model.model import User, UserOut
 
 
 class UserRepoABC(RepoABC, ABC):
@@ -18,3 +30,68 @@ class UserRepo(Repo, UserRepoABC):
         stmt = select(User).where(User.phone == phone)
         user = await self.session.scalar(stmt)
         return user
+
+
+class UserCacheRepoABC(ABC):
+    @abstractmethod
+    async def get_profile(self, pk: int, load: Callable[[], Awaitable[User]]) -> bytes:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def delete(self, *pks: int):
+        raise NotImplementedError
+
+
+class UserCacheRepo(UserCacheRepoABC):
+    """
+    users as their UserOut json, ready to be sent as is. only the UserOut fields are serialized, so the password hash
+    never reaches redis
+    """
+
+    local_cache = LocalCache('user', settings.local_cache_max_bytes, settings.local_cache_ttl)
+    single_flight = SingleFlight()
+    project = staticmethod(projector(UserOut))
+
+    def __init__(self, redis_conn: Redis = Depends(get_redis)):
+        self.redis = redis_conn if isinstance(redis_conn, Redis) else get_redis()
+
+    @staticmethod
+    def key(pk: int) -> str:
+        return f'fast_shop:user:{pk}'
+
+    async def get_profile(self, pk: int, load: Callable[[], Awaitable[User]]) -> bytes:
+        """read-through get of the serialized profile, `load` runs only on a miss of both layers"""
+        key = self.key(pk)
+        if (profile := self.local_cache.get(key)) is not None:
+            return profile
+        generation = self.local_cache.generation
+        profile = await self.single_flight.do(key, lambda: self._get_or_load(key, load))
+        self.local_cache.set(key, profile, len(profile), generation)
+        return profile
+
+    async def _get_or_load(self, key: str, load: Callable[[], Awaitable[User]]) -> bytes:
+        try:
+            if (profile := await self.redis.execute_command('GET', key, NEVER_DECODE=True)) is not None:
+                metrics.inc('UserCache.hits')
+                return profile
+        except RedisError:
+            # profiles are served from the database while redis is down
+            metrics.inc('UserCache.errors')
+            return dumps(self.project(await load()))
+        metrics.inc('UserCache.misses')
+        profile = dumps(self.project(await load()))
+        try:
+            await self.redis.set(key, profile, ex=settings.user_cache_ttl)
+        except RedisError:
+            metrics.inc('UserCache.errors')
+        return profile
+
+    async def delete(self, *pks: int):
+        """to be called after a user changes; drops the profile here and from the local caches of every worker"""
+        if not pks:
+            return
+        keys = [self.key(pk) for pk in pks]
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.delete(*keys)
+            pipe.publish(invalidation_channel, json.dumps(keys))
+            await pipe.execute()
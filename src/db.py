@@ -1,13 +1,166 @@
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+import asyncio
+import itertools
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+
+from redis.exceptions import RedisError
+from sqlalchemy import text
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, AsyncEngine
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.sql.functions import now
 from sqlmodel import SQLModel
 
+from app_infra.app_logger import get_logger
+from app_infra.cache import connect_redis
+from app_infra.query_profiler import instrument_engine
 from config import settings
 
+logger = get_logger()
+
+
+@compiles(now, 'sqlite')
+def sqlite_now(element, compiler, **kw):
+    # CURRENT_TIMESTAMP has whole seconds, too coarse for the updated_at versions that validate responses
+    return "STRFTIME('%Y-%m-%d %H:%M:%f', 'NOW')"
+
 
-engine = create_async_engine(settings.db_url, echo=True)
+engine = create_async_engine(settings.db_url, echo=settings.db_echo)
+instrument_engine(engine)
 async_session_maker = sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
 
+# identifies the client of the current request (set by a middleware) for read-your-writes stickiness
+sticky_key: ContextVar[str | None] = ContextVar('db_sticky_key', default=None)
+# the client wrote recently, its reads go to the primary
+sticky: ContextVar[bool] = ContextVar('db_sticky', default=False)
+
+
+class ReplicaRouter:
+    """
+    picks a healthy replica for plain reads, or None when reads must go to the primary. a client that wrote is marked
+    in redis for replica_sticky_seconds, so its reads stay on the primary whichever worker serves them
+    """
+
+    sticky_prefix = 'fast_shop:sticky:'
+
+    def __init__(self, urls: list[str]):
+        self.engines: list[AsyncEngine] = [create_async_engine(url, echo=settings.db_echo) for url in urls]
+        self.session_makers = {
+            e: sessionmaker(e, expire_on_commit=False, class_=AsyncSession) for e in self.engines
+        }
+        self.healthy: list[AsyncEngine] = list(self.engines)
+        self._round_robin = itertools.count()
+        for e in self.engines:
+            instrument_engine(e)
+
+    def session_maker(self) -> sessionmaker | None:
+        if not self.healthy or sticky.get():
+            return None
+        return self.session_makers[self.healthy[next(self._round_robin) % len(self.healthy)]]
+
+    async def wrote_recently(self, key: str) -> bool:
+        try:
+            return bool(await connect_redis().exists(self.sticky_prefix + key))
+        except RedisError as e:
+            logger.warning('replica stickiness check failed, reading the primary', error=str(e))
+            return True
+
+    async def mark_write(self):
+        key = sticky_key.get()
+        if not self.engines or not key:
+            return
+        try:
+            await connect_redis().set(self.sticky_prefix + key, 1, px=int(settings.replica_sticky_seconds * 1000))
+        except RedisError as e:
+            logger.warning('replica stickiness mark failed', error=str(e))
+
+    async def check_health(self):
+        healthy = []
+        for e in self.engines:
+            try:
+                async with asyncio.timeout(settings.replica_health_check_timeout):
+                    async with e.connect() as conn:
+                        await conn.execute(text('SELECT 1'))
+                healthy.append(e)
+            except Exception as exc:
+                logger.warning('database replica is unhealthy', replica=e.url.host, error=str(exc))
+        self.healthy = healthy
+
+    async def run_health_checks(self):
+        while True:
+            await self.check_health()
+            await asyncio.sleep(settings.replica_health_check_seconds)
+
+    async def dispose(self):
+        for e in self.engines:
+            await e.dispose()
+
+
+replica_router = ReplicaRouter(settings.db_replica_urls)
+
+
+class UnitOfWork:
+    """
+    the sessions of one request, shared by all of its repos. a session takes a pool connection on its first query and
+    gives it back on close(), so a request holds at most one primary (and one replica) connection. `transaction()`
+    groups several repo calls into one transaction; nested calls join the outer one
+    """
+
+    def __init__(self):
+        self.session: AsyncSession = async_session_maker()
+        self._replica_session: AsyncSession | None = None
+        self._depth = 0
+        self._wrote = False
+
+    @property
+    def reader(self) -> AsyncSession:
+        """session for plain reads: a replica, unless this unit of work has written or the client wrote recently"""
+        if self._depth or self._wrote:
+            return self.session
+        if self._replica_session is None:
+            replica_session_maker = replica_router.session_maker()
+            if replica_session_maker is None:
+                return self.session
+            self._replica_session = replica_session_maker()
+        return self._replica_session
+
+    @asynccontextmanager
+    async def transaction(self):
+        if self._depth:
+            self._depth += 1
+            try:
+                yield self.session
+            finally:
+                self._depth -= 1
+            return
+
+        await replica_router.mark_write()
+        # reads after the write must see it, and a replica may not have it yet
+        self._wrote = True
+        if self._replica_session is not None:
+            await self._replica_session.close()
+            self._replica_session = None
+        if self.session.in_transaction():
+            # reads autobegin a transaction, end it before starting the explicit one
+            await self.session.commit()
+        self._depth = 1
+        try:
+            async with self.session.begin():
+                yield self.session
+        finally:
+            self._depth = 0
+
+    async def close(self):
+        await self.session.close()
+        if self._replica_session is not None:
+            await self._replica_session.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
 
 async def make_db():
     async with engine.begin() as conn:
@@ -16,3 +169,4 @@ async def make_db():
 
 async def clean_db():
     await engine.dispose()
+    await replica_router.dispose()
@@ -0,0 +1,86 @@
+from abc import ABC, abstractmethod
+
+
+class Codec(ABC):
+    """turns a cache entry (a json-able dict) into bytes and back"""
+    name: str
+
+    @abstractmethod
+    def encode(self, data: dict) -> bytes:
+        raise NotImplementedError
+
+    @abstractmethod
+    def decode(self, raw: bytes) -> dict:
+        raise NotImplementedError
+
+
+class OrjsonCodec(Codec):
+    name = 'orjson'
+
+    def __init__(self):
+        import orjson
+        self._orjson = orjson
+
+    def encode(self, data: dict) -> bytes:
+        return self._orjson.dumps(data)
+
+    def decode(self, raw: bytes) -> dict:
+        return self._orjson.loads(raw)
+
+
+class MsgpackCodec(Codec):
+    name = 'msgpack'
+
+    def __init__(self):
+        import msgpack  # optional dependency, like the compression libraries: only needed when configured
+        self._msgpack = msgpack
+
+    def encode(self, data: dict) -> bytes:
+        return self._msgpack.packb(data)
+
+    def decode(self, raw: bytes) -> dict:
+        return self._msgpack.unpackb(raw)
+
+
+class CompressedCodec(Codec):
+    """compresses the output of `codec` when it is at least min_bytes long; a header byte tells which it was"""
+
+    raw_header, compressed_header = b'\x00', b'\x01'
+
+    def __init__(self, codec: Codec, algorithm: str, min_bytes: int):
+        if algorithm == 'zstd':
+            import zstandard
+            self._compress, self._decompress = zstandard.ZstdCompressor().compress, zstandard.ZstdDecompressor().decompress
+        elif algorithm == 'lz4':
+            import lz4.frame
+            self._compress, self._decompress = lz4.frame.compress, lz4.frame.decompress
+        else:
+            raise ValueError(f'unknown compression: {algorithm}')
+        self.codec = codec
+        self.min_bytes = min_bytes
+        self.name = f'{codec.name}+{algorithm}'
+
+    def encode(self, data: dict) -> bytes:
+        raw = self.codec.encode(data)
+        if len(raw) < self.min_bytes:
+            return self.raw_header + raw
+        return self.compressed_header + self._compress(raw)
+
+    def decode(self, raw: bytes) -> dict:
+        header, raw = raw[:1], raw[1:]
+        if header == self.compressed_header:
+            raw = self._decompress(raw)
+        return self.codec.decode(raw)
+
+
+codecs = {'orjson': OrjsonCodec, 'msgpack': MsgpackCodec}
+
+
+def make_codec(name: str, compression: str | None = None, min_bytes: int = 512) -> Codec | None:
+    """None for 'json', which means entries are stored as RedisJSON documents"""
+    if name == 'json':
+        return None
+    if name not in codecs:
+        raise ValueError(f'unknown cache codec: {name}')
+    codec = codecs[name]()
+    return CompressedCodec(codec, compression, min_bytes) if compression else codec
@@ -0,0 +1,65 @@
+import hashlib
+from datetime import datetime, UTC
+from email.utils import format_datetime, parsedate_to_datetime
+
+from fastapi import Request, Response, status
+
+# clients may keep responses but have to revalidate them, which is a cheap 304 when nothing changed
+public_cache_control = 'public, no-cache'
+private_cache_control = 'private, no-cache'
+
+
+def weak_etag(*parts) -> str:
+    digest = hashlib.sha1(':'.join(map(str, parts)).encode()).hexdigest()[:20]
+    return f'W/"{digest}"'
+
+
+def has_preconditions(request: Request) -> bool:
+    return 'if-none-match' in request.headers or 'if-modified-since' in request.headers
+
+
+def _utc(moment: datetime) -> datetime:
+    # sqlite drops the timezone, its timestamps are utc
+    return moment.replace(tzinfo=UTC) if moment.tzinfo is None else moment
+
+
+def is_not_modified(request: Request, etag: str, last_modified: datetime | None = None) -> bool:
+    """If-None-Match (weak comparison) or, only when it is absent, If-Modified-Since"""
+    if_none_match = request.headers.get('if-none-match')
+    if if_none_match is not None:
+        tags = {t.strip().removeprefix('W/') for t in if_none_match.split(',')}
+        return '*' in tags or etag.removeprefix('W/') in tags
+    if_modified_since = request.headers.get('if-modified-since')
+    if if_modified_since and last_modified is not None:
+        try:
+            since = _utc(parsedate_to_datetime(if_modified_since))
+        except (TypeError, ValueError):
+            return False
+        return _utc(last_modified).replace(microsecond=0) <= since
+    return False
+
+
+def validator_headers(etag: str, last_modified: datetime | None = None, cache_control: str = private_cache_control):
+    headers = {'ETag': etag, 'Cache-Control': cache_control}
+    if last_modified is not None:
+        headers['Last-Modified'] = format_datetime(_utc(last_modified).astimezone(UTC), usegmt=True)
+    return headers
+
+
+def not_modified_response(headers: dict) -> Response:
+    return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+
+def check_not_modified(
+    request: Request,
+    response: Response,
+    etag: str,
+    last_modified: datetime | None = None,
+    cache_control: str = private_cache_control,
+) -> Response | None:
+    """sets the validators on `response`, and returns a 304 to send instead when the client's copy is current"""
+    headers = validator_headers(etag, last_modified, cache_control)
+    response.headers.update(headers)
+    if is_not_modified(request, etag, last_modified):
+        return not_modified_response(headers)
+    return None
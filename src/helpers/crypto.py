@@ -1,16 +1,114 @@
+import asyncio
 import dataclasses
+import hashlib
+import time
+import uuid
 from abc import ABC
+from collections import OrderedDict
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
 from datetime import datetime, timedelta
 
 import jwt
-from fastapi import Depends
+from fastapi import Depends, Request
 from jwt import ExpiredSignatureError, InvalidTokenError
 from passlib.context import CryptContext
 
+from app_infra.metrics import metrics
+from app_infra.revocation import revocations
 from config import settings
-from helpers.exceptions import credentials_exception
+from helpers.exceptions import credentials_exception, overloaded_exception
 from model.model import User
 
+crypto_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+
+# module level, so a process pool can pickle them
+def _verify(string: str, hashed_string: str) -> bool:
+    return crypto_context.verify(string, hashed_string)
+
+
+def _hash(string: str) -> str:
+    return crypto_context.hash(string)
+
+
+def _timed(fn, submitted: float, *args):
+    started = time.time()
+    return fn(*args), started - submitted, time.time() - started
+
+
+class HashPool:
+    """
+    runs bcrypt off the event loop, on settings.hash_workers threads or processes. at most settings.hash_queue_size
+    calls wait for a worker, the ones beyond are rejected right away, so a login spike can't stall other endpoints
+    """
+
+    def __init__(self):
+        self._executor: Executor | None = None
+        self.pending = 0
+
+    @property
+    def executor(self) -> Executor:
+        if self._executor is None:
+            executor_class = ProcessPoolExecutor if settings.hash_executor == 'process' else ThreadPoolExecutor
+            self._executor = executor_class(max_workers=settings.hash_workers)
+        return self._executor
+
+    async def run(self, fn, *args):
+        if self.pending >= settings.hash_workers + settings.hash_queue_size:
+            metrics.inc('crypto.hash_rejected')
+            raise overloaded_exception
+        self.pending += 1
+        metrics.set('crypto.hash_pending', self.pending)
+        try:
+            loop = asyncio.get_running_loop()
+            result, wait, took = await loop.run_in_executor(self.executor, _timed, fn, time.time(), *args)
+        finally:
+            self.pending -= 1
+            metrics.set('crypto.hash_pending', self.pending)
+        metrics.observe('crypto.hash_queue_wait', wait)
+        metrics.observe('crypto.hash_time', took)
+        return result
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+hash_pool = HashPool()
+
+
+class VerifiedTokens:
+    """a bounded lru of sha256(token) -> payload of tokens whose signature checked out, each kept until its exp"""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._entries: OrderedDict[bytes, dict] = OrderedDict()
+
+    def get(self, digest: bytes) -> dict | None:
+        payload = self._entries.get(digest)
+        if payload is None:
+            return None
+        if payload['exp'] <= time.time():
+            del self._entries[digest]
+            return None
+        self._entries.move_to_end(digest)
+        return payload
+
+    def set(self, digest: bytes, payload: dict):
+        if not self.max_size or not isinstance(payload.get('exp'), (int, float)):
+            return
+        self._entries[digest] = payload
+        self._entries.move_to_end(digest)
+        if len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+
+verified_tokens = VerifiedTokens(settings.token_cache_size)
+
 
 class CryptoABC(ABC):
 
@@ -22,18 +120,30 @@ class CryptoABC(ABC):
     def get_hash(cls, string: str) -> str:
         raise NotImplementedError
 
+    @classmethod
+    async def verify_hash_async(cls, string: str, hashed_string: str) -> bool:
+        raise NotImplementedError
+
+    @classmethod
+    async def get_hash_async(cls, string: str) -> str:
+        raise NotImplementedError
+
     @classmethod
     def create_access_token(cls, user) -> str:
         raise NotImplementedError
 
     @classmethod
-    def parse_token(cls, token: str) -> dict:
+    async def parse_token(cls, request: Request, token: str) -> dict:
+        raise NotImplementedError
+
+    @classmethod
+    def verify_token(cls, token: str) -> dict:
         raise NotImplementedError
 
 
 @dataclasses.dataclass
 class Crypto(CryptoABC):
-    crypto_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+    crypto_context = crypto_context
     algorithm = 'HS512'
 
     @classmethod
@@ -44,19 +154,50 @@ class Crypto(CryptoABC):
     def get_hash(cls, string: str) -> str:
         return cls.crypto_context.hash(string)
 
+    # the async versions are the ones to use in request handlers
+    @classmethod
+    async def verify_hash_async(cls, string: str, hashed_string: str) -> bool:
+        return await hash_pool.run(_verify, string, hashed_string)
+
+    @classmethod
+    async def get_hash_async(cls, string: str) -> str:
+        return await hash_pool.run(_hash, string)
+
     @classmethod
     def create_access_token(cls, user: User) -> str:
         exp_datetime = datetime.now(tz=settings.timezone) + timedelta(seconds=settings.token_expire_seconds)
-        payload = {'sub': user.id, 'scopes': user.scopes.split(), 'exp': exp_datetime}
+        payload = {
+            'sub': user.id, 'scopes': user.scopes.split(), 'exp': exp_datetime, 'iat': time.time(),
+            'jti': uuid.uuid4().hex,
+        }
         token = jwt.encode(payload, settings.secret_key, algorithm=cls.algorithm)
         return token
 
     @classmethod
-    def parse_token(cls, token: str = Depends(settings.auth_scheme)) -> dict:
-        """parses and verifies the access token and returns its payload"""
+    async def parse_token(cls, request: Request, token: str = Depends(settings.auth_scheme)) -> dict:
+        """parses and verifies the access token, checks it is not revoked and returns its payload, once per request"""
+        # fastapi caches dependencies per security scopes, so authorize and get_current_user_id would each parse it
+        memo = getattr(request.state, 'token_payload', None)
+        if memo is not None and memo[0] == token:
+            return memo[1]
+        payload = cls.verify_token(token)
+        # verified tokens are cached, revocations are checked on every request
+        if await revocations.is_revoked(payload):
+            raise credentials_exception
+        request.state.token_payload = (token, payload)
+        return payload
+
+    @classmethod
+    def verify_token(cls, token: str) -> dict:
+        digest = hashlib.sha256(token.encode()).digest()
+        if (payload := verified_tokens.get(digest)) is not None:
+            metrics.inc('crypto.token_cache_hits')
+            return payload
+        metrics.inc('crypto.token_cache_misses')
         try:
             # decode and verify token
             payload = jwt.decode(token, settings.secret_key, algorithms=[cls.algorithm])
-            return payload
         except (ExpiredSignatureError, InvalidTokenError):
             raise credentials_exception
+        verified_tokens.set(digest, payload)
+        return payload
@@ -1,3 +1,5 @@
+import math
+
 from fastapi import HTTPException, status
 
 credentials_exception = HTTPException(
@@ -13,4 +15,34 @@ entity_not_found_exception = HTTPException(
 access_forbidden_exception = HTTPException(
     status_code=status.HTTP_403_FORBIDDEN,
     detail="access forbidden",
-)
\ No newline at end of file
+)
+
+invalid_cursor_exception = HTTPException(
+    status_code=status.HTTP_400_BAD_REQUEST,
+    detail="invalid cursor",
+)
+
+not_ready_exception = HTTPException(
+    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+    detail="not ready",
+)
+
+overloaded_exception = HTTPException(
+    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+    detail="server is busy, try again",
+    headers={'Retry-After': '1'},
+)
+
+
+def too_many_requests_exception(retry_after: float) -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+        detail="too many attempts, try again later",
+        headers={'Retry-After': str(max(math.ceil(retry_after), 1))},
+    )
+
+
+insufficient_stock_exception = HTTPException(
+    status_code=status.HTTP_400_BAD_REQUEST,
+    detail="product not found or quantity more than stock",
+)
@@ -0,0 +1,37 @@
+import csv
+import io
+from datetime import datetime
+from typing import Any, AsyncIterator, Callable, Iterable, Sequence
+
+import orjson
+
+
+async def ndjson_lines(chunks: AsyncIterator[Sequence], project: Callable[[Any], Any]) -> AsyncIterator[bytes]:
+    """one json document per line, one yield per chunk"""
+    async for chunk in chunks:
+        yield b''.join(orjson.dumps(project(row), option=orjson.OPT_APPEND_NEWLINE | orjson.OPT_UTC_Z) for row in chunk)
+
+
+def _csv_value(value):
+    # timestamps are written as the ndjson export writes them
+    if isinstance(value, datetime):
+        return orjson.dumps(value, option=orjson.OPT_UTC_Z)[1:-1].decode()
+    return value
+
+
+async def csv_lines(
+    chunks: AsyncIterator[Sequence],
+    header: Sequence[str],
+    to_rows: Callable[[Any], Iterable[Sequence]],
+) -> AsyncIterator[bytes]:
+    """a header line, then the rows `to_rows` makes of every entity (several for nested ones), one yield per chunk"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(header)
+    yield buffer.getvalue().encode()
+    async for chunk in chunks:
+        buffer.seek(0)
+        buffer.truncate()
+        for row in chunk:
+            writer.writerows([_csv_value(v) for v in values] for values in to_rows(row))
+        yield buffer.getvalue().encode()
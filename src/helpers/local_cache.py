@@ -0,0 +1,84 @@
+import time
+from collections import OrderedDict
+from typing import Any, ClassVar, Hashable, Iterable
+
+from app_infra.metrics import metrics
+
+
+class LocalCache:
+    """
+    bounded in-process LRU cache with a ttl and a budget in bytes (sizes are given by the caller). it is only enabled
+    while its owner can keep it coherent (e.g. while subscribed to invalidations), and the ttl bounds staleness if
+    invalidations are lost anyway
+    """
+
+    instances: ClassVar[list['LocalCache']] = []
+
+    def __init__(self, name: str, max_bytes: int, ttl: float):
+        self.name = name
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.enabled = False
+        self.generation = 0  # bumped by every eviction, so fills racing with an invalidation can be dropped
+        self.size = 0
+        self._entries: OrderedDict[Hashable, tuple[Any, int, float]] = OrderedDict()  # key -> value, size, expiry
+        self.instances.append(self)
+
+    def get(self, key: Hashable) -> Any | None:
+        if not self.enabled:
+            return None
+        entry = self._entries.get(key)
+        if entry is None or entry[2] < time.monotonic():
+            if entry is not None:
+                self._remove(key)
+            self._count('misses')
+            return None
+        self._entries.move_to_end(key)
+        self._count('hits')
+        return entry[0]
+
+    def set(self, key: Hashable, value: Any, size: int, generation: int | None = None):
+        """stores value unless the cache is disabled, the entry is too big, or an eviction happened since the caller
+        read `generation` (before fetching the value)"""
+        if not self.enabled or size > self.max_bytes or (generation is not None and generation != self.generation):
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (value, size, time.monotonic() + self.ttl)
+        self.size += size
+        while self.size > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+            metrics.inc(f'local_cache.{self.name}.evictions')
+        metrics.set(f'local_cache.{self.name}.bytes', self.size)
+
+    def evict(self, keys: Iterable[Hashable]):
+        self.generation += 1
+        for key in keys:
+            if key in self._entries:
+                self._remove(key)
+                metrics.inc(f'local_cache.{self.name}.invalidations')
+
+    def clear(self):
+        self.generation += 1
+        self._entries.clear()
+        self.size = 0
+
+    @classmethod
+    def evict_everywhere(cls, keys: list[Hashable]):
+        for cache in cls.instances:
+            cache.evict(keys)
+
+    @classmethod
+    def set_enabled_everywhere(cls, enabled: bool):
+        for cache in cls.instances:
+            cache.clear()
+            cache.enabled = enabled
+
+    def _remove(self, key: Hashable):
+        _, size, _ = self._entries.pop(key)
+        self.size -= size
+
+    def _count(self, event: str):
+        metrics.inc(f'local_cache.{self.name}.{event}')
+        hit_ratio = metrics.ratio(f'local_cache.{self.name}.hits', f'local_cache.{self.name}.misses')
+        metrics.set(f'local_cache.{self.name}.hit_ratio', hit_ratio)
@@ -0,0 +1,54 @@
+import base64
+import binascii
+import json
+from dataclasses import dataclass, field
+from typing import Sequence
+
+from fastapi import Response
+
+from helpers.conditional import weak_etag, public_cache_control
+from helpers.exceptions import invalid_cursor_exception
+
+
+# cursors are opaque to clients: a url-safe base64 of the sort key of the last row of the page. we seek on `id`, which
+# is the primary key on every table (index-backed, unique and monotonic), so the sort is stable under concurrent inserts
+# and is the same in postgres and in the redisearch cache
+
+
+def encode_cursor(last_id: int) -> str:
+    raw = json.dumps({'id': last_id}, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str | None) -> int | None:
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        return int(json.loads(raw)['id'])
+    except (binascii.Error, ValueError, KeyError, TypeError):
+        raise invalid_cursor_exception
+
+
+@dataclass
+class Page:
+    """a serialized page of a list endpoint, as it is cached"""
+    body: str
+    next_cursor: str | None = None
+    etag: str = field(default='')
+
+    def __post_init__(self):
+        self.etag = self.etag or weak_etag(self.body)
+
+    def response(self) -> Response:
+        headers = {'ETag': self.etag, 'Cache-Control': public_cache_control}
+        if self.next_cursor:
+            headers['X-Next-Cursor'] = self.next_cursor
+        return Response(self.body, media_type='application/json', headers=headers)
+
+
+def next_cursor(rows: Sequence, limit: int) -> str | None:
+    """returns the cursor of the page after `rows`, or None if `rows` is the last page"""
+    if len(rows) < limit:
+        return None
+    return encode_cursor(rows[-1].id)
@@ -0,0 +1,50 @@
+import codecs
+import csv
+from typing import AsyncIterator
+
+import orjson
+
+from model.enums import FileFormat
+
+
+async def read_lines(stream: AsyncIterator[bytes]) -> AsyncIterator[str]:
+    """splits a streamed utf-8 body into lines, holding no more than a line and a network chunk"""
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    tail = ''
+    async for data in stream:
+        tail += decoder.decode(data)
+        *lines, tail = tail.split('\n')
+        for line in lines:
+            yield line
+    tail += decoder.decode(b'', final=True)
+    if tail:
+        yield tail
+
+
+async def read_records(stream: AsyncIterator[bytes], file_format: FileFormat) -> AsyncIterator[tuple[int, dict | str]]:
+    """
+    yields (line number, record) for every non-blank line of an ndjson or csv (with a header) upload. the record is an
+    error message when the line can't be parsed. a csv record can't span lines
+    """
+    header = None
+    line_no = 0
+    async for line in read_lines(stream):
+        line_no += 1
+        line = line.rstrip('\r')
+        if not line.strip():
+            continue
+        if file_format == FileFormat.ndjson:
+            try:
+                record = orjson.loads(line)
+            except orjson.JSONDecodeError as e:
+                yield line_no, f'invalid json: {e}'
+                continue
+            yield line_no, record if isinstance(record, dict) else 'expected a json object'
+            continue
+        row = next(csv.reader([line]))
+        if header is None:
+            header = row
+        elif len(row) != len(header):
+            yield line_no, f'expected {len(header)} columns, got {len(row)}'
+        else:
+            yield line_no, dict(zip(header, row))
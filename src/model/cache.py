@@ -1,17 +1,40 @@
 from datetime import datetime
 
-from aredis_om import JsonModel, Field
+from aredis_om import JsonModel, HashModel, Field
+from pydantic import model_validator
 
 
 class ProductCache(JsonModel):
-    id: int
+    id: int = Field(index=True, sortable=True)
     category: str = Field(index=True)
     info: dict
-    price: int
-    quantity: int
+    sku: str | None = None
+    price: int = Field(index=True, sortable=True)
+    quantity: int = Field(index=True)
+    name: str = Field(default='', index=True, full_text_search=True)  # copy of info['name'] for full-text search
     created_at: datetime | None = None
     updated_at: datetime | None = None
 
+    @model_validator(mode='before')
+    @classmethod
+    def name_from_info(cls, data):
+        if isinstance(data, dict) and not data.get('name'):
+            data = {**data, 'name': str((data.get('info') or {}).get('name', ''))}
+        return data
+
     @classmethod
     def make_key(cls, part: str):
         return f"fast_shop:product:{part}"
+
+
+class ProductIndex(HashModel):
+    """the searchable fields of ProductCache, when products are cached with a byte codec instead of as json"""
+    id: int = Field(index=True, sortable=True)
+    category: str = Field(index=True)
+    price: int = Field(index=True, sortable=True)
+    quantity: int = Field(index=True)
+    name: str = Field(default='', index=True, full_text_search=True)
+
+    @classmethod
+    def make_key(cls, part: str):
+        return f"fast_shop:product_index:{part}"
@@ -8,3 +8,20 @@ class OrderStatus(Enum):
     sent = 'sent'
     delivered = 'delivered'
     cancelled = 'cancelled'
+
+
+class CacheChange(Enum):
+    product = 'product'  # catalog edits, cached list pages go stale too
+    stock = 'stock'  # quantity taken by an order
+
+
+class FileFormat(Enum):
+    ndjson = 'ndjson'
+    csv = 'csv'
+
+
+class ProductSort(Enum):
+    id = 'id'
+    id_desc = '-id'
+    price = 'price'
+    price_desc = '-price'
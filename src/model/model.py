@@ -1,8 +1,9 @@
+import json
 from datetime import datetime
 from typing import Self
 
 import phonenumbers
-from pydantic import EmailStr, SecretStr, model_validator, field_validator, ConfigDict, PositiveInt
+from pydantic import EmailStr, SecretStr, model_validator, field_validator, ConfigDict, PositiveInt, NonNegativeInt
 from sqlalchemy import JSON, DateTime, func, Column, String, CheckConstraint
 from sqlmodel import SQLModel, Field, Relationship
 
@@ -129,19 +130,46 @@ class Order(Base, table=True):
 class ProductBase(SQLModel):
     category: str
     info: dict
-    price: int
+    price: NonNegativeInt
     quantity: PositiveInt
 
 
 class ProductOut(ProductBase, Base):
-    pass
+    quantity: NonNegativeInt  # sold out products have none left
+    sku: str | None = None
+
+
+class ProductImport(ProductBase):
+    """a row of a bulk import. columns that aren't product fields go into info; sku may come from info too"""
+    sku: str = Field(min_length=1)
+
+    @model_validator(mode='before')
+    @classmethod
+    def collect_info(cls, data):
+        if not isinstance(data, dict):
+            return data
+        info = data.get('info') or {}
+        if isinstance(info, str):  # a json column of a csv
+            info = json.loads(info)
+        if not isinstance(info, dict):
+            raise ValueError('info must be a json object')
+        info = {**info, **{k: v for k, v in data.items() if k not in cls.model_fields}}
+        data = {k: v for k, v in data.items() if k in cls.model_fields}
+        return {**data, 'info': info, 'sku': data.get('sku') or info.get('sku')}
 
 
 class Product(Base, table=True):
-    category: str
+    category: str = Field(index=True)
     info: dict = Field(sa_type=JSON())
-    price: int
-    quantity: int = Field(ge=0, sa_column_args=[CheckConstraint('quantity>0')])
+    sku: str | None = Field(default=None, unique=True)  # natural key of bulk imports
+    price: int = Field(index=True)
+    quantity: int = Field(ge=0, sa_column_args=[CheckConstraint('quantity>=0')])  # the last unit can be sold
+
+
+class CacheOutbox(Base, table=True):
+    """a cache change, committed with the database change it mirrors and relayed to redis by app_infra.outbox"""
+    change: str
+    entity_id: int
 
 
 class OrderProductIn(SQLModel):
@@ -1,4 +1,8 @@
-from pydantic import BaseModel, model_validator, field_validator, EmailStr, SecretStr, ConfigDict
+from datetime import datetime
+
+from pydantic import BaseModel, model_validator, field_validator, EmailStr, SecretStr, ConfigDict, NonNegativeInt
+
+from model.enums import ProductSort, FileFormat, OrderStatus
 
 
 class Token(BaseModel):
@@ -8,3 +12,40 @@ class Token(BaseModel):
 class PhoneLogin(BaseModel):
     phone: str
     password: str
+
+
+class ProductFilter(BaseModel):
+    category: str | None = None
+    min_price: NonNegativeInt | None = None
+    max_price: NonNegativeInt | None = None
+    in_stock: bool = False
+    q: str | None = None  # full-text match on the product name (info['name'])
+    sort: ProductSort = ProductSort.id
+
+
+class ExportFilter(BaseModel):
+    created_from: datetime | None = None
+    created_to: datetime | None = None  # exclusive
+    format: FileFormat = FileFormat.ndjson
+
+
+class OrderExportFilter(ExportFilter):
+    status: OrderStatus | None = None
+
+
+class ProductExportFilter(ExportFilter):
+    category: str | None = None
+
+
+class ImportRowError(BaseModel):
+    line: int
+    error: str
+
+
+class ImportReport(BaseModel):
+    dry_run: bool
+    rows: int = 0
+    imported: int = 0  # inserted or updated; with dry_run, the rows that would be
+    failed: int = 0
+    superseded: int = 0  # rows followed by another row of the same sku in their chunk, which was imported instead
+    errors: list[ImportRowError] = []  # the first settings.import_max_errors of them
@@ -4,6 +4,8 @@ from router.auth import router as auth_router
 from router.product import router as product_router
 from router.address import router as address_router
 from router.order import router as order_router
+from router.metrics import router as metrics_router
+from router.health import router as health_router
 
 
 def add_routers(app: FastAPI):
@@ -11,3 +13,5 @@ def add_routers(app: FastAPI):
     app.include_router(product_router)
     app.include_router(address_router)
     app.include_router(order_router)
+    app.include_router(metrics_router)
+    app.include_router(health_router)
@@ -1,8 +1,10 @@
-from fastapi import APIRouter, Depends, status
+from fastapi import APIRouter, Depends, Request, Response, status
 
+from app_infra.rate_limit import auth_rate_limiter
 from app_infra.routes import LogRoute
 from config import settings
-from model.model import User, UserIn, UserOut
+from helpers.crypto import Crypto
+from model.model import UserIn, UserOut
 from model.schema import Token, PhoneLogin
 from service.auth import AuthServiceABC, AuthService
 
@@ -17,21 +19,47 @@ router = APIRouter(route_class=LogRoute, prefix=settings.auth_route_prefix, tags
 
 @router.post("/signup", status_code=status.HTTP_201_CREATED, response_model=UserOut)
 async def signup(
+    request: Request,
     user_in: UserIn,
     auth_service: AuthServiceABC = Depends(AuthService)
 ):
+    # both spend a bcrypt hash, so attempts are limited before any work
+    await auth_rate_limiter.hit(phone=user_in.phone, ip=request.client and request.client.host)
     return await auth_service.signup(user_in)
 
 
 @router.post("/login", response_model=Token)
 async def login(
+    request: Request,
     login_data: PhoneLogin,
     auth_service: AuthServiceABC = Depends(AuthService)
 ):
+    await auth_rate_limiter.hit(phone=login_data.phone, ip=request.client and request.client.host)
     token = await auth_service.authenticate(login_data.phone, login_data.password)
     return Token(access_token=token)
 
 
 @router.get("/me", response_model=UserOut)
-async def get_me(user: User = Depends(AuthService().get_me)):
-    return user
+async def get_me(
+    user_id: int = Depends(AuthService.get_current_user_id),
+    auth_service: AuthServiceABC = Depends(AuthService)
+):
+    # already serialized, and cached, as UserOut
+    return Response(await auth_service.get_me(user_id), media_type='application/json')
+
+
+@router.post("/logout", status_code=status.HTTP_204_NO_CONTENT)
+async def logout(
+    payload: dict = Depends(Crypto.parse_token),
+    auth_service: AuthServiceABC = Depends(AuthService)
+):
+    await auth_service.logout(payload)
+
+
+@router.post("/logout/all", status_code=status.HTTP_204_NO_CONTENT)
+async def logout_everywhere(
+    user_id: int = Depends(AuthService.get_current_user_id),
+    auth_service: AuthServiceABC = Depends(AuthService)
+):
+    # every session of the user, this one included
+    await auth_service.logout_everywhere(user_id)
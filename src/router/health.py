@@ -0,0 +1,19 @@
+from fastapi import APIRouter
+
+from app_infra.warmup import cache_warmer
+from helpers.exceptions import not_ready_exception
+
+router = APIRouter(prefix='/health', tags=['Health'])
+
+
+@router.get("/live")
+async def live():
+    return {'status': 'ok'}
+
+
+@router.get("/ready")
+async def ready():
+    # the cache must hold the hot products before we take traffic
+    if not cache_warmer.ready:
+        raise not_ready_exception
+    return {'status': 'ok'}
@@ -0,0 +1,12 @@
+from fastapi import APIRouter, Security
+
+from app_infra.metrics import metrics
+from app_infra.routes import LogRoute
+from service.auth import AuthService
+
+router = APIRouter(route_class=LogRoute, prefix='/metrics', tags=['Metrics'])
+
+
+@router.get("/")
+async def get_metrics(_=Security(AuthService.authorize, scopes=["admin"])):
+    return metrics.snapshot()
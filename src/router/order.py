@@ -1,9 +1,17 @@
-from fastapi import APIRouter, status, Depends
+from fastapi import APIRouter, status, Depends, Query, Request, Response, Security
+from fastapi.responses import StreamingResponse
 
+from app_infra.query_profiler import query_budget
 from app_infra.routes import LogRoute
+from app_infra.serialization import trusted_response
+from config import settings
 from data.order import OrderRepoABC, OrderRepo
+from helpers.conditional import has_preconditions, check_not_modified, weak_etag
+from helpers.pagination import decode_cursor, next_cursor
 from model.model import OrderIn, OrderCreateOut, OrderOut
+from model.schema import OrderExportFilter
 from service.auth import AuthService
+from service.export import ExportServiceABC, ExportService, media_types
 from service.order import OrderServiceABC, OrderService
 
 router = APIRouter(route_class=LogRoute, prefix='/order', tags=['Order'])
@@ -19,21 +27,47 @@ async def create(
     return order
 
 
+@router.get("/export")
+async def export(
+    filters: OrderExportFilter = Depends(),
+    export_service: ExportServiceABC = Depends(ExportService),
+    _=Security(AuthService.authorize, scopes=["admin"]),
+):
+    headers = {'Content-Disposition': f'attachment; filename="orders.{filters.format.value}"'}
+    return StreamingResponse(export_service.orders(filters), media_type=media_types[filters.format], headers=headers)
+
+
 @router.get("/{pk}", response_model=OrderOut)
+@trusted_response
 async def get(
     pk: int,
+    request: Request,
+    response: Response,
     user_id: int = Depends(AuthService.get_current_user_id),
     order_repo: OrderRepoABC = Depends(OrderRepo),
 ):
-    return await order_repo.get_one(pk=pk, user_id=user_id)
+    if has_preconditions(request) and (updated_at := await order_repo.get_version(pk, user_id)):
+        if not_modified := check_not_modified(request, response, weak_etag(pk, updated_at), updated_at):
+            return not_modified
+    order = await order_repo.get_one(pk=pk, user_id=user_id)
+    updated_at = order_repo.version_of(order)
+    return check_not_modified(request, response, weak_etag(order.id, updated_at), updated_at) or order
 
 
 @router.get("/", response_model=list[OrderOut])
+@query_budget(3)
+@trusted_response
 async def get_all(
-    page: int = 1,
+    response: Response,
+    page: int = Query(default=1, ge=1),
+    limit: int = Query(default=settings.default_page_size, ge=1, le=settings.max_page_size),
+    cursor: str | None = None,
     user_id: int = Depends(AuthService.get_current_user_id),
     order_repo: OrderRepoABC = Depends(OrderRepo),
 ):
-    limit = 10
-    result = await order_repo.get(offset=(page-1)*limit, limit=limit, user_id=user_id)
+    # a cursor (taken from X-Next-Cursor of the previous page) takes precedence over page
+    after = decode_cursor(cursor)
+    result = await order_repo.get(offset=(page-1)*limit, limit=limit, after=after, user_id=user_id)
+    if next_page := next_cursor(result, limit):
+        response.headers['X-Next-Cursor'] = next_page
     return result
@@ -1,81 +1,169 @@
-from aredis_om import NotFoundError
-from fastapi import APIRouter, status, Depends, Security
+from typing import Awaitable, Callable, Sequence
+
+from fastapi import APIRouter, status, Depends, Security, Query, Request, Response
+from fastapi.responses import StreamingResponse
+from redis.exceptions import RedisError
 
 from app_infra.dependencies import get_redis
+from app_infra.metrics import metrics
 from app_infra.routes import LogRoute
+from app_infra.serialization import trusted_response, projector, dumps
+from config import settings
 from data.product import ProductRepoABC, ProductRepo, ProductCacheRepo, ProductCacheRepoABC
+from helpers.conditional import (
+    has_preconditions, is_not_modified, check_not_modified, not_modified_response, validator_headers, weak_etag,
+    public_cache_control,
+)
+from helpers.pagination import decode_cursor, next_cursor, Page
 from model.cache import ProductCache
-from model.model import ProductBase, ProductOut, Product
+from model.model import ProductBase, ProductOut
+from helpers.upload import read_records
+from model.enums import FileFormat
+from model.schema import ProductFilter, ProductExportFilter, ImportReport
 from service.auth import AuthService
+from service.export import ExportServiceABC, ExportService, media_types
+from service.product import ProductServiceABC, ProductService
 
 router = APIRouter(route_class=LogRoute, prefix='/product', tags=['Product'])
 
+products_out = projector(list[ProductOut])
+
+
+async def cached_page(
+    request: Request,
+    kind: str,
+    params: dict,
+    product_cache_repo: ProductCacheRepoABC,
+    load: Callable[[], Awaitable[tuple[Sequence, str | None]]],
+) -> Response:
+    """serves a list page from the page cache, loading, serializing and caching it on a miss"""
+    # the etag of a cached page can be checked without transferring the page
+    if 'if-none-match' in request.headers:
+        etag = await product_cache_repo.get_page_etag(kind, params)
+        if etag and is_not_modified(request, etag):
+            return not_modified_response(validator_headers(etag, cache_control=public_cache_control))
+
+    version, page = await product_cache_repo.get_page(kind, params)
+    if page is None:
+        products, next_page = await load()
+        body = dumps(products_out(products)).decode()
+        page = Page(body, next_page)
+        await product_cache_repo.save_page(kind, params, version, page)
+    if is_not_modified(request, page.etag):
+        return not_modified_response(validator_headers(page.etag, cache_control=public_cache_control))
+    return page.response()
+
 
 @router.post("/", status_code=status.HTTP_201_CREATED, response_model=ProductOut)
 async def create(
     product_in: ProductBase,
+    product_service: ProductServiceABC = Depends(ProductService),
+    _=Security(AuthService.authorize, scopes=["admin"]),
+):
+    return await product_service.create(product_in)
+
+
+@router.post("/import", response_model=ImportReport)
+async def import_products(
+    request: Request,
+    file_format: FileFormat = Query(default=FileFormat.ndjson, alias='format'),
+    dry_run: bool = False,
+    product_service: ProductServiceABC = Depends(ProductService),
+    _=Security(AuthService.authorize, scopes=["admin"]),
+):
+    # the body is read as it arrives, never whole
+    return await product_service.import_products(read_records(request.stream(), file_format), dry_run)
+
+
+@router.get("/search", response_model=list[ProductOut])
+async def search(
+    request: Request,
+    filters: ProductFilter = Depends(),
+    page: int = Query(default=1, ge=1),
+    limit: int = Query(default=settings.default_page_size, ge=1, le=settings.max_page_size),
     product_repo: ProductRepoABC = Depends(ProductRepo),
     product_cache_repo: ProductCacheRepoABC = Depends(ProductCacheRepo),
+):
+    offset = (page-1)*limit
+
+    async def load():
+        return await product_cache_repo.search(filters, limit=limit, offset=offset), None
+
+    try:
+        # the index only finds cached products, so it is searched once a warm-up has cached all of them
+        if await product_cache_repo.is_complete():
+            params = {**filters.model_dump(mode='json'), 'page': page, 'limit': limit}
+            return await cached_page(request, 'search', params, product_cache_repo, load)
+    except RedisError:
+        pass
+    metrics.inc('product.search.sql_fallbacks')
+    return await product_repo.search(filters, limit=limit, offset=offset)
+
+
+@router.get("/export")
+async def export(
+    filters: ProductExportFilter = Depends(),
+    export_service: ExportServiceABC = Depends(ExportService),
     _=Security(AuthService.authorize, scopes=["admin"]),
 ):
-    product = Product.model_validate(product_in)
-    await product_repo.in_tran(product)
-    await product_cache_repo.save(product)
-    return product
+    headers = {'Content-Disposition': f'attachment; filename="products.{filters.format.value}"'}
+    return StreamingResponse(export_service.products(filters), media_type=media_types[filters.format], headers=headers)
 
 
 @router.get("/{pk}", response_model=ProductOut)
+@trusted_response
 async def get(
     pk: int,
+    request: Request,
+    response: Response,
     product_repo: ProductRepoABC = Depends(ProductRepo),
     product_cache_repo: ProductCacheRepoABC = Depends(ProductCacheRepo),
 ):
-    try:
-        product = await product_cache_repo.get(pk)
-    except NotFoundError:
-        product = await product_repo.get_one(id=pk)
-        await product_cache_repo.save(product)
-    return product
+    # revalidation only needs updated_at, which redis has apart from the product
+    if has_preconditions(request) and (updated_at := await product_cache_repo.get_version(pk)):
+        if not_modified := check_not_modified(request, response, weak_etag(pk, updated_at), updated_at,
+                                              public_cache_control):
+            return not_modified
+    product = await product_cache_repo.get_or_load(pk, lambda: product_repo.get_current(id=pk))
+    etag = weak_etag(product.id, product.updated_at)
+    return check_not_modified(request, response, etag, product.updated_at, public_cache_control) or product
 
 
 @router.put("/{pk}", response_model=ProductOut)
 async def update(
     pk: int,
     product: ProductBase,
-    product_repo: ProductRepoABC = Depends(ProductRepo),
-    product_cache_repo: ProductCacheRepoABC = Depends(ProductCacheRepo),
+    product_service: ProductServiceABC = Depends(ProductService),
     _=Security(AuthService.authorize, scopes=["admin"]),
 ):
-    product_values = product.model_dump()
-    update_stmt = product_repo.update({'id': pk}, product_values)
-    await product_repo.in_tran(update_stmt)
-    product = await product_repo.get_one(id=pk)
-    await product_cache_repo.save(product)
-    return product
+    return await product_service.update(pk, product)
 
 
 @router.delete("/{pk}", status_code=status.HTTP_204_NO_CONTENT)
 async def delete(
     pk: int,
-    product_repo: ProductRepoABC = Depends(ProductRepo),
-    product_cache_repo: ProductCacheRepoABC = Depends(ProductCacheRepo),
+    product_service: ProductServiceABC = Depends(ProductService),
     _=Security(AuthService.authorize, scopes=["admin"]),
 ):
-    await product_cache_repo.delete(pk)
-    delete_stmt = product_repo.delete(id=pk)
-    await product_repo.in_tran(delete_stmt)
+    await product_service.delete(pk)
 
 
 @router.get("/", response_model=list[ProductOut])
 async def get_all(
-    page: int = 1,
+    request: Request,
+    page: int = Query(default=1, ge=1),
+    limit: int = Query(default=settings.default_page_size, ge=1, le=settings.max_page_size),
+    cursor: str | None = None,
     product_repo: ProductRepoABC = Depends(ProductRepo),
     product_cache_repo: ProductCacheRepoABC = Depends(ProductCacheRepo),
 ):
-    limit = 10
-    offset = (page-1)*limit
-    products = await product_cache_repo.all(offset=offset, limit=limit)
-    if not products:
-        products = await product_repo.get(offset=offset, limit=limit)
-        await product_cache_repo.save(products)
-    return products
+    # a cursor (taken from X-Next-Cursor of the previous page) takes precedence over page
+    after = decode_cursor(cursor)
+
+    async def load():
+        # only the page is cached here, the products are cached by the outbox relay and the warm-up
+        products = await product_repo.get(offset=(page-1)*limit, limit=limit, after=after)
+        return products, next_cursor(products, limit)
+
+    params = {'cursor': cursor} if cursor else {'page': page}
+    return await cached_page(request, 'list', {**params, 'limit': limit}, product_cache_repo, load)
@@ -5,7 +5,8 @@ from fastapi import Depends, status, HTTPException
 from fastapi.security import SecurityScopes
 from sqlalchemy.exc import IntegrityError
 
-from data.user import UserRepoABC, UserRepo
+from app_infra.revocation import revocations
+from data.user import UserRepoABC, UserRepo, UserCacheRepoABC, UserCacheRepo
 from helpers.crypto import Crypto, CryptoABC
 from helpers.exceptions import credentials_exception, access_forbidden_exception
 from model.model import User, UserIn
@@ -14,6 +15,7 @@ from model.model import User, UserIn
 @dataclasses.dataclass
 class AuthServiceABC(ABC):
     user_repo: UserRepoABC
+    user_cache_repo: UserCacheRepoABC
     crypto: CryptoABC
 
     @staticmethod
@@ -33,10 +35,24 @@ class AuthServiceABC(ABC):
     async def get_me(self, pk):
         raise NotImplementedError
 
+    @abstractmethod
+    async def logout(self, payload: dict):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def logout_everywhere(self, user_id: int):
+        raise NotImplementedError
+
 class AuthService(AuthServiceABC):
 
-    def __init__(self, user_repo: UserRepoABC = Depends(UserRepo), crypto: CryptoABC = Depends(Crypto)):
+    def __init__(
+        self,
+        user_repo: UserRepoABC = Depends(UserRepo),
+        user_cache_repo: UserCacheRepoABC = Depends(UserCacheRepo),
+        crypto: CryptoABC = Depends(Crypto),
+    ):
         self.user_repo = user_repo if isinstance(user_repo, UserRepoABC) else UserRepo()
+        self.user_cache_repo = user_cache_repo if isinstance(user_cache_repo, UserCacheRepoABC) else UserCacheRepo()
         self.crypto = crypto if isinstance(crypto, CryptoABC) else Crypto()
 
     @staticmethod
@@ -61,18 +77,25 @@ class AuthService(AuthServiceABC):
 
     async def authenticate(self, phone: str, password: str) -> str:
         user = await self.user_repo.get_one_by_phone(phone)
-        if not user or not self.crypto.verify_hash(password, user.password):
+        if not user or not await self.crypto.verify_hash_async(password, user.password):
             raise credentials_exception
         return self.crypto.create_access_token(user)
 
     async def signup(self, user_in: UserIn) -> User:
         user = User.model_validate(user_in)
-        user.password = self.crypto.get_hash(user_in.password.get_secret_value())
+        user.password = await self.crypto.get_hash_async(user_in.password.get_secret_value())
         try:
             await self.user_repo.in_tran(user)
             return user
         except IntegrityError:
             raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail='User already exists')
 
-    async def get_me(self, pk: int = Depends(get_current_user_id)) -> User:
-        return await self.user_repo.get_one(id=pk)
+    async def get_me(self, pk: int) -> bytes:
+        """the user's UserOut json"""
+        return await self.user_cache_repo.get_profile(pk, lambda: self.user_repo.get_one(id=pk))
+
+    async def logout(self, payload: dict):
+        await revocations.revoke_token(payload)
+
+    async def logout_everywhere(self, user_id: int):
+        await revocations.revoke_user(user_id)
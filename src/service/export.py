@@ -0,0 +1,67 @@
+from abc import ABC, abstractmethod
+from typing import AsyncIterator
+
+from app_infra.serialization import projector
+from config import settings
+from data.order import OrderRepo
+from data.product import ProductRepo
+from db import UnitOfWork
+from helpers.export import ndjson_lines, csv_lines
+from model.enums import FileFormat
+from model.model import Order, OrderOut, Product, ProductOut
+from model.schema import OrderExportFilter, ProductExportFilter
+
+media_types = {FileFormat.ndjson: 'application/x-ndjson', FileFormat.csv: 'text/csv'}
+
+
+class ExportServiceABC(ABC):
+    @abstractmethod
+    def orders(self, filters):
+        raise NotImplementedError
+
+    @abstractmethod
+    def products(self, filters):
+        raise NotImplementedError
+
+
+class ExportService(ExportServiceABC):
+    """
+    exports are streamed after the endpoint returns, when the request's unit of work is closed already, so they read
+    through a unit of work of their own. each chunk is sent before the next one is fetched, so a slow client slows the
+    cursor down instead of piling rows up in memory
+    """
+
+    async def orders(self, filters: OrderExportFilter) -> AsyncIterator[bytes]:
+        async with UnitOfWork() as uow:
+            chunks = OrderRepo(uow).stream_export(filters, settings.export_chunk_size)
+            if filters.format == FileFormat.csv:
+                header = ['order_id', 'status', 'created_at', 'address_id', 'product_id', 'quantity', 'price']
+                lines = csv_lines(chunks, header, self._order_rows)
+            else:
+                lines = ndjson_lines(chunks, projector(OrderOut))
+            async for line in lines:
+                yield line
+
+    async def products(self, filters: ProductExportFilter) -> AsyncIterator[bytes]:
+        async with UnitOfWork() as uow:
+            chunks = ProductRepo(uow).stream_export(filters, settings.export_chunk_size)
+            if filters.format == FileFormat.csv:
+                header = ['id', 'category', 'name', 'price', 'quantity', 'created_at', 'updated_at']
+                lines = csv_lines(chunks, header, self._product_rows)
+            else:
+                lines = ndjson_lines(chunks, projector(ProductOut))
+            async for line in lines:
+                yield line
+
+    @staticmethod
+    def _order_rows(order: Order):
+        # one row per line item, an order without any gets one with empty item columns
+        order_columns = (order.id, order.status, order.created_at, order.address_id)
+        if not order.products:
+            return [(*order_columns, None, None, None)]
+        return [(*order_columns, p.product_id, p.quantity, p.price) for p in order.products]
+
+    @staticmethod
+    def _product_rows(product: Product):
+        return [(product.id, product.category, product.info.get('name', ''), product.price, product.quantity,
+                 product.created_at, product.updated_at)]
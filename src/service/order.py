@@ -1,11 +1,15 @@
 from abc import ABC, abstractmethod
+from collections import Counter
 from dataclasses import dataclass
 
 from fastapi import Depends, HTTPException, status
 
+from app_infra.outbox import outbox_relay
 from data.Address import AddressRepo, AddressRepoABC
 from data.order import OrderRepoABC, OrderRepo
+from data.outbox import OutboxRepoABC, OutboxRepo
 from data.product import ProductRepo, ProductRepoABC
+from model.enums import CacheChange
 from model.model import Order, OrderIn
 
 
@@ -26,10 +30,12 @@ class OrderService(OrderServiceABC):
             address_repo: AddressRepoABC = Depends(AddressRepo),
             order_repo: OrderRepoABC = Depends(OrderRepo),
             product_repo: ProductRepoABC = Depends(ProductRepo),
+            outbox_repo: OutboxRepoABC = Depends(OutboxRepo),
     ):
         self.address_repo = address_repo if isinstance(address_repo, AddressRepoABC) else AddressRepo()
         self.order_repo = order_repo if isinstance(order_repo, OrderRepoABC) else OrderRepo()
         self.product_repo = product_repo if isinstance(product_repo, ProductRepoABC) else ProductRepo()
+        self.outbox_repo = outbox_repo if isinstance(outbox_repo, OutboxRepoABC) else OutboxRepo(self.order_repo.uow)
 
     async def create(self, order_in: OrderIn, user_id: int) -> Order:
         order = Order.model_validate(order_in)
@@ -37,16 +43,14 @@ class OrderService(OrderServiceABC):
         if not await self.address_repo.exists(id=order.address_id, user_id=user_id):
             raise HTTPException(detail="invalid ", status_code=status.HTTP_400_BAD_REQUEST)
 
-        order_product_ids = [o.product_id for o in order.products]
-        stock_products = {s.id: s for s in await self.product_repo.get_by_ids(order_product_ids)}
-
-        # check stock quantity
+        quantities = Counter()
         for p in order.products:
-            stock_product = stock_products[p.product_id]
-            if p.quantity > stock_product.quantity:
-                raise HTTPException(detail="quantity for than stock", status_code=status.HTTP_400_BAD_REQUEST)
-            p.price = stock_product.price
-            stock_product.quantity -= p.quantity
-
-        await self.order_repo.in_tran(order, *stock_products.values())
+            quantities[p.product_id] += p.quantity
+        reservation = self.product_repo.reserve(quantities)
+
+        async with self.order_repo.uow.transaction():
+            order = await self.order_repo.create(order, reservation)
+            # cached stock of these products is stale now
+            await self.outbox_repo.add(CacheChange.stock, quantities)
+        await outbox_relay.notify()
         return order
@@ -0,0 +1,125 @@
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from typing import AsyncIterator
+
+from fastapi import Depends
+from pydantic import ValidationError
+from sqlalchemy.exc import SQLAlchemyError
+
+from app_infra.outbox import outbox_relay
+from config import settings
+from data.outbox import OutboxRepoABC, OutboxRepo
+from data.product import ProductRepoABC, ProductRepo
+from model.enums import CacheChange
+from model.model import Product, ProductBase, ProductImport
+from model.schema import ImportReport, ImportRowError
+
+
+@dataclass
+class ProductServiceABC(ABC):
+    product_repo: ProductRepoABC
+    outbox_repo: OutboxRepoABC
+
+    @abstractmethod
+    async def create(self, product_in):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def update(self, pk, product_in):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def delete(self, pk):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def import_products(self, records, dry_run):
+        raise NotImplementedError
+
+
+class ProductService(ProductServiceABC):
+    """product writes; the cache follows them through the outbox"""
+
+    def __init__(
+            self,
+            product_repo: ProductRepoABC = Depends(ProductRepo),
+            outbox_repo: OutboxRepoABC = Depends(OutboxRepo),
+    ):
+        self.product_repo = product_repo if isinstance(product_repo, ProductRepoABC) else ProductRepo()
+        self.outbox_repo = outbox_repo if isinstance(outbox_repo, OutboxRepoABC) else OutboxRepo(self.product_repo.uow)
+
+    async def create(self, product_in: ProductBase) -> Product:
+        product = Product.model_validate(product_in)
+        async with self.product_repo.uow.transaction():
+            await self.product_repo.in_tran(product)
+            await self.outbox_repo.add(CacheChange.product, [product.id])
+        await outbox_relay.notify()
+        return product
+
+    async def update(self, pk: int, product_in: ProductBase) -> Product:
+        async with self.product_repo.uow.transaction():
+            await self.product_repo.in_tran(self.product_repo.update({'id': pk}, product_in.model_dump()))
+            await self.outbox_repo.add(CacheChange.product, [pk])
+        await outbox_relay.notify()
+        return await self.product_repo.get_one(id=pk)
+
+    async def delete(self, pk: int):
+        async with self.product_repo.uow.transaction():
+            await self.product_repo.in_tran(self.product_repo.delete(id=pk))
+            await self.outbox_repo.add(CacheChange.product, [pk])
+        await outbox_relay.notify()
+
+    async def import_products(self, records: AsyncIterator[tuple[int, dict | str]], dry_run: bool) -> ImportReport:
+        """
+        upserts the records (see helpers.upload.read_records) by sku, a chunk per statement and transaction, so memory
+        is bounded by the chunk size and a bad row only fails itself. the cache is filled by the outbox relay
+        """
+        report = ImportReport(dry_run=dry_run)
+        chunk: dict[str, tuple[int, dict]] = {}  # sku -> line, row
+        async for line, record in records:
+            report.rows += 1
+            try:
+                if isinstance(record, str):
+                    raise ValueError(record)
+                row = ProductImport.model_validate(record)
+            except ValueError as e:
+                self._report_error(report, line, e)
+                continue
+            if row.sku in chunk:
+                # a sku repeated within a chunk: the last row wins
+                report.superseded += 1
+            chunk[row.sku] = line, row.model_dump()
+            if len(chunk) >= settings.import_chunk_size:
+                await self._import_chunk(chunk, dry_run, report)
+                chunk = {}
+        if chunk:
+            await self._import_chunk(chunk, dry_run, report)
+        return report
+
+    async def _import_chunk(self, chunk: dict[str, tuple[int, dict]], dry_run: bool, report: ImportReport):
+        if dry_run:
+            report.imported += len(chunk)
+            return
+        rows = [row for _, row in chunk.values()]
+        try:
+            async with self.product_repo.uow.transaction():
+                products = await self.product_repo.bulk_upsert(rows, conflict_keys=['sku'], chunk_size=len(rows))
+                await self.outbox_repo.add(CacheChange.product, [p.id for p in products])
+        except SQLAlchemyError as e:
+            # the chunk was rolled back, the chunks before it stay imported
+            for line, _ in chunk.values():
+                self._report_error(report, line, ValueError(f'chunk not imported: {e.__class__.__name__}'))
+            return
+        report.imported += len(products)
+        await outbox_relay.notify()
+
+    @staticmethod
+    def _report_error(report: ImportReport, line: int, error: ValueError):
+        report.failed += 1
+        if len(report.errors) >= settings.import_max_errors:
+            return
+        if isinstance(error, ValidationError):
+            message = '; '.join(f"{'.'.join(map(str, e['loc'])) or 'row'}: {e['msg']}" for e in error.errors())
+        else:
+            message = str(error)
+        report.errors.append(ImportRowError(line=line, error=message))
@@ -0,0 +1,20 @@
+import asyncio
+
+from app_infra.app_logger import make_logger
+from app_infra.cache import make_cache, clean_cache
+from app_infra.warmup import cache_warmer
+from db import clean_db
+
+
+async def warm_cache():
+    make_logger()
+    await make_cache()
+    try:
+        await cache_warmer.warm_up(force=True)
+    finally:
+        await clean_cache()
+        await clean_db()
+
+
+if __name__ == '__main__':
+    asyncio.run(warm_cache())
@@ -3,13 +3,14 @@ import asyncio
 from fastapi import FastAPI
 
 from app_infra.app import make_app
-from app_infra.cache import make_cache
+from app_infra.cache import make_cache, clean_cache
 from db import make_db
 
 
 async def init():
     await make_db()
     await make_cache()
+    await clean_cache()
 
 
 asyncio.run(init())
@@ -1,12 +1,38 @@
+import asyncio
+import csv
+import io
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+
+import orjson
 import pytest
 import pytest_asyncio
+from fastapi import HTTPException
 from httpx import AsyncClient, ASGITransport
+from redis.asyncio import Redis
 
 from data.Address import AddressRepo
-from data.product import ProductRepo
-from data.user import UserRepo
-from helpers.crypto import Crypto
-from model.model import User, Address, Product
+from data.order import OrderRepo
+from data.product import ProductRepo, ProductCacheRepo
+from data.user import UserRepo, UserCacheRepo
+from db import ReplicaRouter, UnitOfWork, sticky, sticky_key
+from helpers.codec import CompressedCodec, make_codec
+from helpers.crypto import Crypto, hash_pool
+from helpers.exceptions import entity_not_found_exception
+from app_infra.cache import clean_cache, connect_redis
+from app_infra.metrics import metrics
+from app_infra.rate_limit import RateLimiter
+from app_infra.revocation import Revocations, revocations
+from app_infra.serialization import UtcZResponse, projector
+from app_infra.warmup import cache_warmer
+from router import auth as auth_router
+from service.auth import AuthService
+from model.cache import ProductCache
+from model.enums import ProductSort
+from model.schema import ProductFilter
+from model.model import User, Address, Product, ProductOut, Order, OrderOut, OrderProduct
 from tests.app import pytest_app
 
 
@@ -16,6 +42,13 @@ async def get_access_header(client: AsyncClient, credentials: dict) -> dict:
     return {'X-API-Key': access_token}
 
 
+@pytest_asyncio.fixture(autouse=True)
+async def redis_pool():
+    # every test runs in its own event loop, and pooled redis connections can't outlive theirs
+    yield
+    await clean_cache()
+
+
 @pytest_asyncio.fixture()
 async def create_default_users():
     admin = User(
@@ -103,6 +136,12 @@ async def test_authentication():
         response_data = response.json()
         assert response_data['nid'] == user['nid']
         assert response_data['phone'] == '+982133551020'
+        assert 'password' not in response_data
+
+        response = await client.post('/auth/logout', headers=access_header)
+        assert response.status_code == 204
+        response = await client.get('/auth/me', headers=access_header)
+        assert response.status_code == 401
 
 
 async def test_product_manipulation(create_default_users):
@@ -142,11 +181,18 @@ async def test_product_manipulation(create_default_users):
         assert response_data['category'] == 'mobile'
         assert response_data['info']['name'] == 'asus'
 
+        response = await client.get('/product/?limit=100')
+        assert [p['category'] for p in response.json() if p['id'] == pk] == ['mobile']
+
         response_data['category'] = 'laptop'
         response = await client.put(url, json=response_data, headers=admin_access_header)
         response_data = response.json()
         assert response_data['category'] == 'laptop'
 
+        # the update bumped the catalog version, so the cached list page is not served anymore
+        response = await client.get('/product/?limit=100')
+        assert [p['category'] for p in response.json() if p['id'] == pk] == ['laptop']
+
         response = await client.delete(url, headers=admin_access_header)
         assert response.status_code == 204
 
@@ -241,15 +287,111 @@ async def test_order_manipulation(create_user_and_address_and_products):
         response_data = response.json()
         pk = response_data.get('id')
 
+        # the outbox relayed the new stock to the cache
+        response = await client.get(f'/product/{product_1.id}')
+        assert response.json()['quantity'] == 9
+
         response = await client.get(f'/order/{pk}', headers=access_header)
         assert response.status_code == 200
 
+        response = await client.get(f'/order/{pk}', headers={**access_header, 'If-None-Match': response.headers['ETag']})
+        assert response.status_code == 304
+
         response = await client.get(f'/order/?page=1', headers=access_header)
         assert response.status_code == 200
         response_data = response.json()
         assert len(response_data) > 0
 
 
+async def test_order_stock(create_user_and_address_and_products):
+    user, address, product_1, product_2 = create_user_and_address_and_products
+
+    async def stock(product):
+        async with UnitOfWork() as uow:
+            return (await ProductRepo(uow).get_one(id=product.id)).quantity
+
+    def order(*lines):
+        return {'address_id': address.id, 'products': [{'product_id': p.id, 'quantity': q} for p, q in lines]}
+
+    async with AsyncClient(transport=ASGITransport(app=pytest_app), base_url="http://test") as client:
+        credentials = {'phone': '+9822334411', 'password': 'user_password'}
+        access_header = await get_access_header(client, credentials)
+
+        response = await client.post('/order/', json=order((product_1, 16)), headers=access_header)
+        assert response.status_code == 400
+        assert await stock(product_1) == 15
+
+        # one line short of stock rolls back the others
+        response = await client.post('/order/', json=order((product_1, 5), (product_2, 11)), headers=access_header)
+        assert response.status_code == 400
+        assert (await stock(product_1), await stock(product_2)) == (15, 10)
+
+        # the last units can be sold
+        response = await client.post('/order/', json=order((product_2, 10)), headers=access_header)
+        assert response.status_code == 201
+        assert await stock(product_2) == 0
+        response = await client.get(f'/product/{product_2.id}')
+        assert response.status_code == 200
+        assert response.json()['quantity'] == 0
+
+
+async def test_export(create_default_users, create_user_and_address_and_products):
+    user, address, product_1, product_2 = create_user_and_address_and_products
+    january, february = datetime(2024, 1, 1), datetime(2024, 2, 1)
+    with_items = Order(
+        address_id=address.id, status='created', created_at=january,
+        products=[OrderProduct(product_id=product_1.id, quantity=2, price=500)],
+    )
+    without_items = Order(address_id=address.id, status='paid', created_at=february, products=[])
+    await OrderRepo().in_tran(with_items, without_items)
+
+    async with AsyncClient(transport=ASGITransport(app=pytest_app), base_url="http://test") as client:
+        credentials = {'phone': '+9811111111', 'password': 'admin_password'}
+        admin_access_header = await get_access_header(client, credentials)
+
+        response = await client.get('/order/export?status=paid', headers=admin_access_header)
+        assert response.status_code == 200
+        orders = [orjson.loads(line) for line in response.text.splitlines()]
+        assert [(o['id'], o['products']) for o in orders] == [(without_items.id, [])]
+
+        response = await client.get('/order/export?format=csv&created_to=2024-01-15T00:00:00',
+                                    headers=admin_access_header)
+        rows = list(csv.DictReader(io.StringIO(response.text)))
+        assert [(r['order_id'], r['product_id'], r['quantity']) for r in rows] == [
+            (str(with_items.id), str(product_1.id), '2')
+        ]
+        assert rows[0]['created_at'] == '2024-01-01T00:00:00'
+
+        # an order without line items still gets its row
+        response = await client.get('/order/export?format=csv&created_from=2024-01-15T00:00:00',
+                                    headers=admin_access_header)
+        rows = list(csv.DictReader(io.StringIO(response.text)))
+        assert [(r['order_id'], r['status'], r['product_id']) for r in rows] == [(str(without_items.id), 'paid', '')]
+
+        # both formats write timestamps alike
+        response = await client.get('/product/export?category=laptop', headers=admin_access_header)
+        ndjson_product = orjson.loads(response.text)
+        response = await client.get('/product/export?format=csv&category=laptop', headers=admin_access_header)
+        csv_product, = csv.DictReader(io.StringIO(response.text))
+        assert csv_product['created_at'] == ndjson_product['created_at']
+
+
+async def test_trusted_serialization():
+    at = datetime(2024, 1, 2, 3, 4, 5, 678000, tzinfo=timezone.utc)
+    product = Product(
+        id=1, category='mobile', info={'name': 'nokia'}, sku='sku-1', price=100, quantity=0,
+        created_at=at, updated_at=at,
+    )
+    line = OrderProduct(id=1, quantity=2, price=100, product=product, created_at=at, updated_at=at)
+    order = Order(id=1, status='created', status_date=at, products=[line], created_at=at, updated_at=at)
+
+    # the projector path of trusted_response endpoints writes what fastapi's validation path writes
+    for model, obj in ((ProductOut, product), (OrderOut, order)):
+        validated = UtcZResponse(model.model_validate(obj).model_dump(mode='json')).body
+        assert b'05.678000Z' in validated
+        assert UtcZResponse(projector(model)(obj)).body == validated
+
+
 async def test_product_list(create_user_and_address_and_products):
     async with AsyncClient(transport=ASGITransport(app=pytest_app), base_url="http://test") as client:
         response = await client.get(f'/product/?page=1')
@@ -257,3 +399,299 @@ async def test_product_list(create_user_and_address_and_products):
         response_data = response.json()
         assert len(response_data) > 0
 
+
+async def test_product_list_cursor(create_user_and_address_and_products):
+    async with AsyncClient(transport=ASGITransport(app=pytest_app), base_url="http://test") as client:
+        response = await client.get('/product/?limit=1')
+        assert response.status_code == 200
+        first_page = response.json()
+        assert len(first_page) == 1
+        cursor = response.headers['X-Next-Cursor']
+
+        response = await client.get(f'/product/?limit=1&cursor={cursor}')
+        assert response.status_code == 200
+        second_page = response.json()
+        assert len(second_page) == 1
+        assert second_page[0]['id'] > first_page[0]['id']
+
+        response = await client.get('/product/?cursor=not-a-cursor')
+        assert response.status_code == 400
+
+
+async def test_product_search(create_user_and_address_and_products):
+    async with AsyncClient(transport=ASGITransport(app=pytest_app), base_url="http://test") as client:
+        # cache all products, search runs on the cache index once it is complete
+        await cache_warmer.warm_up(force=True)
+
+        response = await client.get('/product/search?category=laptop&min_price=1500&in_stock=true')
+        assert response.status_code == 200
+        response_data = response.json()
+        assert len(response_data) > 0
+        assert all(p['category'] == 'laptop' and p['price'] >= 1500 for p in response_data)
+
+        response = await client.get('/product/search?q=beats&sort=-price')
+        assert response.status_code == 200
+        assert all(p['info']['name'] == 'beats' for p in response.json())
+
+
+async def test_product_cache_misses():
+    cache_repo = ProductCacheRepo()
+    pk = -1 - uuid.uuid4().int % 10 ** 9
+    missing_key = ProductCache.make_key(f'missing:{pk}')
+    loads = []
+
+    async def not_found():
+        loads.append(pk)
+        raise entity_not_found_exception
+
+    async def load():
+        loads.append(pk)
+        await asyncio.sleep(0.05)
+        return Product(id=pk, category='mobile', info={'name': 'nokia'}, price=100, quantity=5)
+
+    try:
+        # a 404 is remembered, the next miss doesn't reach the database
+        for _ in range(2):
+            with pytest.raises(HTTPException) as e:
+                await cache_repo.get_or_load(pk, not_found)
+            assert e.value.status_code == 404
+        assert len(loads) == 1
+        assert await connect_redis().exists(missing_key)
+
+        # saving the product forgets the 404
+        await cache_repo.save(await load())
+        assert not await connect_redis().exists(missing_key)
+
+        # concurrent misses of one product load it once
+        await cache_repo.delete(pk)
+        loads.clear()
+        cached = await asyncio.gather(*(cache_repo.get_or_load(pk, load) for _ in range(5)))
+        assert len(loads) == 1
+        assert [c.id for c in cached] == [pk] * 5
+    finally:
+        await cache_repo.delete(pk)
+
+
+@pytest.mark.parametrize('name, compression', [
+    ('orjson', None), ('msgpack', None), ('orjson', 'zstd'), ('orjson', 'lz4'), ('msgpack', 'zstd'),
+])
+async def test_cache_codec(name, compression):
+    # msgpack and the compression libraries are optional dependencies
+    for module in ({'msgpack': 'msgpack'}.get(name), {'zstd': 'zstandard', 'lz4': 'lz4.frame'}.get(compression)):
+        if module:
+            pytest.importorskip(module)
+    codec = make_codec(name, compression, min_bytes=256)
+    small = {'id': 1, 'category': 'mobile', 'info': {'name': 'nokia'}, 'sku': None, 'price': 100}
+    large = {**small, 'info': {'description': 'a long description ' * 50}}
+    for data in (small, large):
+        assert codec.decode(codec.encode(data)) == data
+    if compression:
+        assert codec.encode(small)[:1] == CompressedCodec.raw_header
+        assert codec.encode(large)[:1] == CompressedCodec.compressed_header
+        assert len(codec.encode(large)) < len(codec.codec.encode(large))
+
+
+async def test_product_cache_orjson_codec(monkeypatch):
+    monkeypatch.setattr(ProductCacheRepo, 'codec', make_codec('orjson'))
+    category = uuid.uuid4().hex
+    products = [Product(id=-i, category=category, info={'name': f'codec {i}'}, price=i, quantity=i) for i in (1, 2)]
+    cache_repo = ProductCacheRepo()
+    try:
+        await cache_repo.save(*products)
+        cached = await cache_repo.get_many([-1, -2, -3])
+        assert [c and c.info['name'] for c in cached] == ['codec 1', 'codec 2', None]
+        found = await cache_repo.search(ProductFilter(category=category, sort=ProductSort.price_desc))
+        assert [p.id for p in found] == [-2, -1]
+    finally:
+        await cache_repo.delete(-1, -2)
+
+
+async def test_product_import(create_default_users):
+    async with AsyncClient(transport=ASGITransport(app=pytest_app), base_url="http://test") as client:
+        credentials = {'phone': '+9811111111', 'password': 'admin_password'}
+        admin_access_header = await get_access_header(client, credentials)
+        headers = {**admin_access_header, 'Content-Type': 'text/csv'}
+        upload = 'sku,category,price,quantity,name\nsku-1,mobile,100,5,nokia\nsku-2,mobile,-1,5,htc\n'
+
+        response = await client.post('/product/import?format=csv&dry_run=true', content=upload, headers=headers)
+        assert response.status_code == 200
+        assert response.json()['imported'] == 1
+
+        response = await client.post('/product/import?format=csv', content=upload, headers=headers)
+        response_data = response.json()
+        assert response_data['imported'] == 1
+        assert response_data['failed'] == 1
+        assert response_data['errors'][0]['line'] == 3
+
+        # same sku again: updated, not duplicated
+        response = await client.post('/product/import?format=csv', content=upload.replace(',5,nokia', ',7,nokia'),
+                                     headers=headers)
+        assert response.json()['imported'] == 1
+        response = await client.get('/product/search?q=nokia')
+        assert [p['quantity'] for p in response.json()] == [7]
+
+        # a sku repeated in one upload: the later row is imported and the report adds up
+        response = await client.post('/product/import?format=csv', content=upload + 'sku-1,mobile,100,9,nokia\n',
+                                     headers=headers)
+        response_data = response.json()
+        assert (response_data['rows'], response_data['imported'], response_data['failed']) == (3, 1, 1)
+        assert response_data['superseded'] == 1
+        response = await client.get('/product/search?q=nokia')
+        assert [p['quantity'] for p in response.json()] == [9]
+
+
+async def test_login_rate_limit(create_default_users, monkeypatch):
+    authenticated = []
+    authenticate = AuthService.authenticate
+
+    async def counting_authenticate(self, phone, password):
+        authenticated.append(phone)
+        return await authenticate(self, phone, password)
+
+    monkeypatch.setattr(AuthService, 'authenticate', counting_authenticate)
+    name = f'test_{uuid.uuid4().hex}'  # windows of earlier runs may still be open in redis
+    monkeypatch.setattr(auth_router, 'auth_rate_limiter', RateLimiter(name, 60, {'phone': 2, 'ip': 1000}))
+    credentials = {'phone': '+9822334455', 'password': 'buyer_password'}
+
+    async with AsyncClient(transport=ASGITransport(app=pytest_app), base_url="http://test") as client:
+        for _ in range(2):
+            response = await client.post('/auth/login', json=credentials)
+            assert response.status_code == 200
+
+        # shed by this worker's token bucket
+        response = await client.post('/auth/login', json=credentials)
+        assert response.status_code == 429
+        assert int(response.headers['Retry-After']) > 0
+
+        # another worker (fresh buckets) is stopped by the window in redis
+        monkeypatch.setattr(auth_router, 'auth_rate_limiter', RateLimiter(name, 60, {'phone': 2, 'ip': 1000}))
+        response = await client.post('/auth/login', json=credentials)
+        assert response.status_code == 429
+        assert int(response.headers['Retry-After']) > 0
+
+    assert len(authenticated) == 2
+    # rejected attempts are not counted
+    assert await connect_redis().zcard(f'fast_shop:rate:{name}:phone:+9822334455') == 2
+
+
+async def test_hash_pool_full(create_default_users, monkeypatch):
+    monkeypatch.setattr('config.settings.hash_workers', 1)
+    monkeypatch.setattr('config.settings.hash_queue_size', 0)
+    release = threading.Event()
+    busy = asyncio.create_task(hash_pool.run(release.wait, 5))  # takes the only slot
+    try:
+        while hash_pool.pending == 0:
+            await asyncio.sleep(0)
+        async with AsyncClient(transport=ASGITransport(app=pytest_app), base_url="http://test") as client:
+            credentials = {'phone': '+9811111111', 'password': 'admin_password'}
+            response = await client.post('/auth/login', json=credentials)
+            assert response.status_code == 503
+            assert response.headers['Retry-After'] == '1'
+
+            release.set()
+            await busy
+            response = await client.post('/auth/login', json=credentials)
+            assert response.status_code == 200
+    finally:
+        release.set()
+        await asyncio.gather(busy, return_exceptions=True)
+
+
+async def test_logout_everywhere(create_default_users):
+    async with AsyncClient(transport=ASGITransport(app=pytest_app), base_url="http://test") as client:
+        credentials = {'phone': '+9822334455', 'password': 'buyer_password'}
+        first_header = await get_access_header(client, credentials)
+        second_header = await get_access_header(client, credentials)
+
+        response = await client.post('/auth/logout/all', headers=first_header)
+        assert response.status_code == 204
+        for header in (first_header, second_header):
+            response = await client.get('/auth/me', headers=header)
+            assert response.status_code == 401
+
+        # tokens issued afterwards are valid
+        response = await client.get('/auth/me', headers=await get_access_header(client, credentials))
+        assert response.status_code == 200
+
+
+async def test_user_cache_redis_down():
+    user = User(id=-1, nid='3333333333', first_name='a', last_name='b', phone='+9833333333', password='hash')
+
+    async def load():
+        return user
+
+    profile = await UserCacheRepo(Redis(port=1)).get_profile(user.id, load)
+    assert orjson.loads(profile)['phone'] == user.phone
+    assert 'password' not in orjson.loads(profile)
+
+
+async def test_replica_reads(monkeypatch):
+    router = ReplicaRouter(['sqlite+aiosqlite://'])
+    monkeypatch.setattr('db.replica_router', router)
+    sticky_key.set(f'user:{uuid.uuid4().hex}')
+    try:
+        async with UnitOfWork() as uow:
+            assert uow.reader.bind is router.engines[0]
+            async with uow.transaction() as session:
+                assert uow.reader is session
+            # the replica may not have the write yet
+            assert uow.reader is uow.session
+
+        # the next requests of the client read the primary too, on any worker
+        assert await router.wrote_recently(sticky_key.get())
+        assert not await router.wrote_recently(f'user:{uuid.uuid4().hex}')
+        sticky.set(True)
+        async with UnitOfWork() as uow:
+            assert uow.reader is uow.session
+    finally:
+        await router.dispose()
+
+
+async def test_revocation_filter():
+    listener = asyncio.create_task(revocations.listen())
+    try:
+        async with asyncio.timeout(5):
+            while not revocations.synced:
+                await asyncio.sleep(0.01)
+
+        def payload(sub):
+            return {'sub': sub, 'jti': uuid.uuid4().hex, 'iat': time.time(), 'exp': time.time() + 60}
+        revoked, fresh = payload(-1), payload(-2)
+        member = f'jti:{revoked["jti"]}'
+
+        # revoked by another worker, reaches this one over pub/sub
+        await Revocations().revoke_token(revoked)
+        async with asyncio.timeout(5):
+            while member not in revocations.bloom:
+                await asyncio.sleep(0.01)
+
+        checks = metrics.counters['revocation.redis_checks']
+        assert not await revocations.is_revoked(fresh)
+        assert metrics.counters['revocation.redis_checks'] == checks  # answered by the filter
+        assert await revocations.is_revoked(revoked)
+        assert metrics.counters['revocation.redis_checks'] == checks + 1
+
+        # a rebuilt filter is loaded from redis
+        await revocations._rebuild()
+        assert member in revocations.bloom
+    finally:
+        listener.cancel()
+        await asyncio.gather(listener, return_exceptions=True)
+
+
+async def test_revocation_redis_down(monkeypatch):
+    def payload(sub):
+        return {'sub': sub, 'jti': uuid.uuid4().hex, 'iat': time.time(), 'exp': time.time() + 60}
+    revoked, fresh = payload(-1), payload(-2)
+    checker = Revocations()
+    await checker.revoke_token(revoked)
+    await checker._rebuild()
+    checker.synced = False  # e.g. the subscription was lost, every check goes to redis
+
+    monkeypatch.setattr('app_infra.revocation.connect_redis', lambda: Redis(port=1))
+    errors = metrics.counters['revocation.redis_errors']
+    assert not await checker.is_revoked(fresh)  # cleared by the filter
+    assert await checker.is_revoked(revoked)
+    monkeypatch.setattr('config.settings.revocation_fail_closed', False)
+    assert not await checker.is_revoked(revoked)
+    assert metrics.counters['revocation.redis_errors'] == errors + 3